@@ -1,6 +1,8 @@
 import os
 from flask import Flask
 from .models import db
+from .database import configure_engine
+from . import metrics, profiling
 from .auth import auth
 from .decorators import json, etag
 from .errors import not_found, not_allowed
@@ -13,10 +15,18 @@ def create_app(config_module=None):
                            'config')
 
     db.init_app(app)
+    with app.app_context():
+        for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or []):
+            configure_engine(db.get_engine(app, bind), app.config)
+    profiling.init_app(app)
+    metrics.init_app(app)
 
     from api.v1 import api as api_blueprint
     app.register_blueprint(api_blueprint, url_prefix='/v1')
 
+    from api.stats import stats as stats_blueprint
+    app.register_blueprint(stats_blueprint, url_prefix='/stats')
+
     if app.config['USE_TOKEN_AUTH']:
         from api.token import token as token_blueprint
         app.register_blueprint(token_blueprint, url_prefix='/auth')
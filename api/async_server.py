@@ -0,0 +1,34 @@
+"""Cooperative server for the API, based on gevent.
+
+The standard library modules are patched so that blocking socket
+operations, such as database and Redis queries, yield to other requests
+instead of blocking the process. The application runs unchanged, each
+request is handled in a greenlet, and a single process can serve thousands
+of concurrent clients. Database drivers that are implemented in C, such as
+psycopg2, need to be made cooperative separately (for example with the
+psycogreen package), and CPU bound work such as password hashing should use
+the 'gevent' hashing pool.
+
+Usage: python -m api.async_server [port]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from .app import create_app
+
+
+def make_server(app, host='127.0.0.1', port=5000, log='default'):
+    """Return a gevent WSGI server for the application. The number of
+    requests that are handled concurrently is limited by the
+    ASYNC_MAX_CONNECTIONS configuration variable."""
+    return WSGIServer((host, port), app,
+                      spawn=Pool(app.config['ASYNC_MAX_CONNECTIONS']),
+                      log=log)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    make_server(create_app(), port=port).serve_forever()
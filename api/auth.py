@@ -1,21 +1,98 @@
+import hashlib
+import hmac
 from flask import current_app, g
 from flask_httpauth import HTTPBasicAuth
-from .models import User
+from .models import db, User
 from .errors import unauthorized
+from .cache import get_cache, generation, model_namespace, shared_timeout
+from .database import replicas_lagging
+from .signing import get_token_signer
+from .passwords import needs_rehash
+from .profiling import timed
+from .metrics import AUTH_CACHE
 
 auth = HTTPBasicAuth()
 
 
+class AuthenticatedUser(object):
+    """Lightweight record of an authenticated user, which can be stored in
+    the cache instead of the database model."""
+    def __init__(self, id, username, tier):
+        self.id = id
+        self.username = username
+        self.tier = tier or 'default'
+
+    def generate_auth_token(self, expires_in=3600):
+        return get_token_signer().sign(self.id, expires_in)
+
+
+def load_user(id):
+    """Return the record of the user with the given id, or None if the user
+    does not exist. Records are cached until the user changes."""
+    key = 'user:{0}:{1}'.format(generation(model_namespace(User, id)), id)
+    cache = get_cache()
+    user = cache.get(key)
+    if user is None:
+        AUTH_CACHE.inc('user', 'miss')
+        user = User.query.get(id)
+        if user is None:
+            return None
+        user = AuthenticatedUser(user.id, user.username, user.tier)
+        if not replicas_lagging():
+            cache.set(key, user,
+                      shared_timeout(current_app.config['AUTH_CACHE_TIMEOUT']))
+    else:
+        AUTH_CACHE.inc('user', 'hit')
+    return user
+
+
+def verify_credentials(username, password):
+    """Return the record of the user with the given username and password,
+    or None if the credentials are invalid. Successful verifications are
+    cached for a short time, so that clients that send the same credentials
+    with every request do not pay for a password hash each time. Passwords
+    hashed with an outdated method are rehashed."""
+    # the cache key is keyed with the application's secret, so the cached
+    # entries cannot be used to guess passwords
+    digest = hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'),
+                      (username + '\0' + password).encode('utf-8'),
+                      hashlib.sha256).hexdigest()
+    key = 'credentials:' + digest
+    cache = get_cache()
+    hit = cache.get(key)
+    if hit is not None:
+        id, gen = hit
+        # the entry is only valid if the user did not change since then
+        if generation(model_namespace(User, id)) == gen:
+            AUTH_CACHE.inc('credentials', 'hit')
+            return load_user(id)
+
+    AUTH_CACHE.inc('credentials', 'miss')
+    user = User.query.filter_by(username=username).first()
+    if user is None or not user.verify_password(password):
+        return None
+    if needs_rehash(user.password_hash):
+        user.password = password
+        db.session.add(user)
+        db.session.commit()
+    if not replicas_lagging():
+        cache.set(key, (user.id, generation(model_namespace(User, user.id))),
+                  shared_timeout(
+                      current_app.config['CREDENTIALS_CACHE_TIMEOUT']))
+    return load_user(user.id)
+
+
 @auth.verify_password
 def verify_password(username_or_token, password):
-    if current_app.config['USE_TOKEN_AUTH']:
-        # token authentication
-        g.user = User.verify_auth_token(username_or_token)
-        return g.user is not None
-    else:
-        # username/password authentication
-        g.user = User.query.filter_by(username=username_or_token).first()
-        return g.user is not None and g.user.verify_password(password)
+    with timed('auth'):
+        if current_app.config['USE_TOKEN_AUTH']:
+            # token authentication
+            id = User.load_auth_token(username_or_token)
+            g.user = load_user(id) if id is not None else None
+        else:
+            # username/password authentication
+            g.user = verify_credentials(username_or_token, password)
+    return g.user is not None
 
 
 @auth.error_handler
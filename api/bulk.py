@@ -0,0 +1,98 @@
+import itertools
+import json
+from flask import request, current_app
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import FlushError
+from .models import db
+from .errors import ValidationError
+
+
+def get_bulk_items():
+    """Return an iterator with the items sent in the body of a bulk request.
+    The body can be a JSON array, or newline delimited JSON when the content
+    type is application/x-ndjson. NDJSON bodies are read one line at a time,
+    so large requests do not need to be loaded in memory."""
+    if request.mimetype == 'application/x-ndjson':
+        return _ndjson_items(request.stream)
+    items = request.get_json(force=True)
+    if not isinstance(items, list):
+        raise ValidationError('Invalid bulk request: expected a list')
+    return iter(items)
+
+
+def _ndjson_items(stream):
+    for line in stream:
+        line = line.decode('utf-8').strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # let the import report the error for this item
+                yield None
+
+
+def bulk_import(items, factory, prepare=None):
+    """Create resources from a sequence of items. Each item is converted to
+    a model instance by the factory function, which normally invokes the
+    model's import_data() method. The instances are inserted in chunks,
+    with a single transaction per chunk. Chunks that fail with a conflict
+    are inserted again one item at a time. If given, the prepare function is
+    invoked with each chunk before its items are imported, which allows
+    related objects to be loaded in batches. Returns a list with the status
+    of each item."""
+    chunk_size = current_app.config['BULK_CHUNK_SIZE']
+    results = []
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            break
+        if prepare is not None:
+            prepare(chunk)
+        objects = []
+        for data in chunk:
+            try:
+                if not isinstance(data, dict):
+                    raise ValidationError('Invalid item')
+                obj = factory(data)
+            except ValidationError as e:
+                results.append({'status': 400, 'error': 'bad request',
+                                'message': str(e)})
+                continue
+            result = {'status': 201}
+            results.append(result)
+            objects.append((obj, result))
+
+        # the unit of work inserts rows with known primary keys, such as
+        # registrations, in a single executemany. Rows with generated keys
+        # are inserted one at a time to obtain the key of each, which the
+        # location of the item needs, and which bulk_insert_mappings() also
+        # does when asked to return them
+        db.session.add_all([obj for obj, result in objects])
+        try:
+            db.session.flush()
+            # the URLs are obtained before the commit expires the objects
+            for obj, result in objects:
+                result['location'] = obj.get_url()
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            _import_one_by_one(objects)
+    return results
+
+
+def _import_one_by_one(objects):
+    # insert the objects of a chunk that failed one at a time, each in its
+    # own savepoint, so that only the items that conflict are rejected
+    for obj, result in objects:
+        result.pop('location', None)
+        try:
+            with db.session.begin_nested():
+                db.session.add(obj)
+            result['location'] = obj.get_url()
+        except (IntegrityError, FlushError):
+            # FlushError reports a duplicate of an item of the same chunk
+            result.clear()
+            result.update({'status': 409, 'error': 'conflict',
+                           'message': 'The item conflicts with an existing '
+                                      'resource'})
+    db.session.commit()
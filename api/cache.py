@@ -0,0 +1,169 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+from flask import current_app, has_app_context
+from redis import Redis
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_mapper
+from .profiling import timed
+
+
+class LRUCache(object):
+    """In-process cache. Items expire after a timeout, and the least recently
+    used items are discarded when the cache grows beyond its maximum size."""
+    def __init__(self, max_items=1000, default_timeout=300):
+        self.max_items = max_items
+        self.default_timeout = default_timeout
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.items.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            self.items[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        """Store a value. A timeout of 0 stores the value without
+        expiration."""
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else None
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expires, value)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class RedisCache(object):
+    """Cache stored in a Redis server, which can be shared by all the
+    processes that run the application."""
+    def __init__(self, redis, key_prefix='api:', default_timeout=300):
+        self.redis = redis
+        self.key_prefix = key_prefix
+        self.default_timeout = default_timeout
+
+    def get(self, key):
+        with timed('redis'):
+            value = self.redis.get(self.key_prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        """Store a value. A timeout of 0 stores the value without
+        expiration."""
+        if timeout is None:
+            timeout = self.default_timeout
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with timed('redis'):
+            self.redis.set(self.key_prefix + key, value, ex=timeout or None)
+
+    def delete(self, key):
+        with timed('redis'):
+            self.redis.delete(self.key_prefix + key)
+
+    def clear(self):
+        keys = self.redis.keys(self.key_prefix + '*')
+        if keys:
+            self.redis.delete(*keys)
+
+
+def get_cache():
+    """Return the cache used by the current application. The cache backend
+    is selected with the CACHE_TYPE configuration variable, which can be
+    'lru' or 'redis'."""
+    cache = current_app.extensions.get('api_cache')
+    if cache is None:
+        config = current_app.config
+        if config['CACHE_TYPE'] == 'redis':
+            cache = RedisCache(Redis.from_url(config['CACHE_REDIS_URL']),
+                               default_timeout=config['CACHE_TIMEOUT'])
+        else:
+            cache = LRUCache(config['CACHE_MAX_ITEMS'],
+                             default_timeout=config['CACHE_TIMEOUT'])
+        current_app.extensions['api_cache'] = cache
+    return cache
+
+
+def shared_timeout(timeout):
+    """Return the timeout of a cached item that must be discarded in every
+    process when the data it was built from changes. Invalidations only
+    reach the in-process cache of the process that made the change, so with
+    the 'lru' backend such items are kept for at most LOCAL_CACHE_TIMEOUT
+    seconds."""
+    config = current_app.config
+    if config['CACHE_TYPE'] == 'redis':
+        return timeout
+    if not timeout:
+        return config['LOCAL_CACHE_TIMEOUT']
+    return min(timeout, config['LOCAL_CACHE_TIMEOUT'])
+
+
+def generation(name):
+    """Return the current generation of a cache namespace. Keys that include
+    the generation become unreachable when the namespace is invalidated."""
+    cache = get_cache()
+    gen = cache.get('gen:' + name)
+    if gen is None:
+        gen = invalidate(name)
+    return gen
+
+
+def invalidate(name):
+    """Invalidate all the cached items in a namespace."""
+    # an expired or evicted generation is replaced with a new one, which
+    # only causes cache misses, so generations can use the default timeout
+    gen = uuid.uuid4().hex
+    get_cache().set('gen:' + name, gen)
+    return gen
+
+
+def model_namespace(model, *primary_key):
+    """Return the cache namespace for a model, or for a single instance of
+    the model when its primary key is given."""
+    return ':'.join([model.__tablename__] + [str(k) for k in primary_key])
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_changes(session, flush_context):
+    # remember which rows were written to, so that cached data that
+    # depends on them can be invalidated once the changes are committed
+    changes = session.info.setdefault('cache_changes', set())
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        changes.add(model_namespace(obj))
+        changes.add(model_namespace(
+            obj, *object_mapper(obj).primary_key_from_instance(obj)))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changes(session):
+    changes = session.info.pop('cache_changes', set())
+    if has_app_context():
+        for name in changes:
+            invalidate(name)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('cache_changes', None)
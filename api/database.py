@@ -0,0 +1,236 @@
+import functools
+import math
+import random
+import time
+from flask import current_app, request, g, has_request_context
+from flask_sqlalchemy import SQLAlchemy
+try:
+    from flask_sqlalchemy import SignallingSession
+except ImportError:  # pragma: no cover
+    from flask_sqlalchemy import _SignallingSession as SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import UpdateBase
+from .cache import get_cache
+from .slow_queries import configure_slow_query_log
+
+POOL_OPTIONS = ['pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle']
+
+
+class StatsQueuePool(QueuePool):
+    """Connection pool that records how many checkouts had to wait for a
+    connection to be returned to the pool, and for how long."""
+    def __init__(self, *args, **kwargs):
+        super(StatsQueuePool, self).__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _do_get(self):
+        if self.checkedin() > 0 or self._max_overflow < 0 or \
+                self.overflow() < self._max_overflow:
+            # a connection is available, or a new one can be opened
+            return super(StatsQueuePool, self)._do_get()
+        start = time.time()
+        try:
+            return super(StatsQueuePool, self)._do_get()
+        finally:
+            self.waits += 1
+            self.wait_time += time.time() - start
+
+    def recreate(self):
+        pool = super(StatsQueuePool, self).recreate()
+        pool.waits = self.waits
+        pool.wait_time = self.wait_time
+        return pool
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the queries issued while handling GET and HEAD
+    requests to the read replicas given in the DATABASE_REPLICAS
+    configuration variable. All other queries go to the primary database,
+    including reads done after the session has written to the database in
+    the current transaction, and the queries of clients that committed a
+    write in the last DATABASE_REPLICA_LAG seconds, so that they do not
+    read data that has not reached the replicas yet."""
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and not isinstance(clause, UpdateBase) and \
+                not self.info.get('writes'):
+            replica = self._get_replica()
+            if replica is not None:
+                return self.db.get_engine(self.app, bind=replica)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _get_replica(self):
+        # the replica is chosen once per request, and again once the client
+        # is authenticated
+        if not has_request_context():
+            return None
+        req = request._get_current_object()
+        key = _last_write_key()
+        route = self.info.get('route')
+        if route is None or route[0] is not req or route[1] != key:
+            replica = None
+            replicas = self.app.config['DATABASE_REPLICAS']
+            if replicas and req.method in ['GET', 'HEAD'] and \
+                    get_cache().get(key) is None:
+                replica = random.choice(replicas)
+            route = self.info['route'] = (req, key, replica)
+        return route[2]
+
+
+LAST_WRITE_KEY = 'replica:last_write'
+
+
+def _last_write_key():
+    # the time of the last write is also recorded for each user, so that
+    # only the clients that made a change are kept off the replicas
+    user = g.get('user') if has_request_context() else None
+    if user is None:
+        return LAST_WRITE_KEY
+    return '{0}:{1}'.format(LAST_WRITE_KEY, user.id)
+
+
+def replicas_lagging():
+    """Return True if a write was committed in the last DATABASE_REPLICA_LAG
+    seconds, so the replicas may not have it yet. The write invalidated the
+    shared caches, so data read while the replicas are lagging must not be
+    stored in them, or the outdated data would be served to all the clients
+    until it expires."""
+    return bool(current_app.config['DATABASE_REPLICAS']) and \
+        get_cache().get(LAST_WRITE_KEY) is not None
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def _record_writes(session, flush_context):
+    session.info['writes'] = True
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _record_commit(session):
+    if not isinstance(session, RoutingSession):
+        return
+    lag = session.app.config['DATABASE_REPLICA_LAG']
+    if session.info.pop('writes', False) and \
+            session.app.config['DATABASE_REPLICAS'] and lag > 0:
+        cache = get_cache()
+        for key in set([LAST_WRITE_KEY, _last_write_key()]):
+            cache.set(key, time.time(), int(math.ceil(lag)))
+    session.info.pop('route', None)
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def _discard_writes(session):
+    session.info.pop('writes', None)
+
+
+class Database(SQLAlchemy):
+    """Flask-SQLAlchemy extension that configures the connection pool from
+    the SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW, SQLALCHEMY_POOL_TIMEOUT,
+    SQLALCHEMY_POOL_RECYCLE and DATABASE_POOL_PRE_PING configuration
+    variables, and routes read queries to replicas with a RoutingSession."""
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(
+            functools.partial(RoutingSession, self, **options),
+            scopefunc=scopefunc)
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            # SQLite connections are not pooled
+            for option in POOL_OPTIONS:
+                options.pop(option, None)
+        rv = super(Database, self).apply_driver_hacks(app, info, options)
+        if 'poolclass' not in options:
+            options['poolclass'] = StatsQueuePool
+            # connections closed by the server are replaced transparently
+            options['pool_pre_ping'] = app.config['DATABASE_POOL_PRE_PING']
+            max_overflow = app.config['SQLALCHEMY_MAX_OVERFLOW']
+            if max_overflow is not None:
+                options['max_overflow'] = max_overflow
+        return rv
+
+
+def _configure_sqlite(engine, config):
+    timeout = config['DATABASE_STATEMENT_TIMEOUT']
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if config['SQLITE_JOURNAL_MODE']:
+            cursor.execute('PRAGMA journal_mode = ' +
+                           config['SQLITE_JOURNAL_MODE'])
+        if config['SQLITE_SYNCHRONOUS']:
+            cursor.execute('PRAGMA synchronous = ' +
+                           config['SQLITE_SYNCHRONOUS'])
+        cursor.close()
+        if timeout:
+            # SQLite does not have statement timeouts, so statements are
+            # interrupted from a progress handler once their deadline passes
+            info = connection_record.info
+
+            def check_deadline():
+                deadline = info.get('statement_deadline')
+                return 1 if deadline and time.time() > deadline else 0
+            dbapi_connection.set_progress_handler(check_deadline, 1000)
+
+    if timeout:
+        @event.listens_for(engine, 'before_cursor_execute')
+        def set_deadline(conn, cursor, statement, parameters, context,
+                         executemany):
+            conn.connection.info['statement_deadline'] = \
+                time.time() + timeout
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def clear_deadline(conn, cursor, statement, parameters, context,
+                           executemany):
+            conn.connection.info.pop('statement_deadline', None)
+
+
+def configure_engine(engine, config):
+    """Install the connection event handlers that apply the database
+    configuration of the application to an engine."""
+    if config['SLOW_QUERY_LOG']:
+        configure_slow_query_log(engine, config)
+
+    timeout = config['DATABASE_STATEMENT_TIMEOUT']
+    if engine.dialect.name == 'sqlite':
+        _configure_sqlite(engine, config)
+    elif timeout and engine.dialect.name in ['postgresql', 'mysql']:
+        if engine.dialect.name == 'postgresql':
+            statement = 'SET statement_timeout = {0}'
+        else:
+            statement = 'SET SESSION max_execution_time = {0}'
+        statement = statement.format(int(timeout * 1000))
+
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(statement)
+            cursor.close()
+            # the DBAPI opened a transaction for the SET statement, which on
+            # PostgreSQL would be undone by the rollback the pool issues
+            # when the connection is returned
+            dbapi_connection.commit()
+
+
+def pool_stats(engine):
+    """Return statistics about the connection pool of an engine."""
+    pool = engine.pool
+    stats = {'pool': pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({'size': pool.size(),
+                      'checked_in': pool.checkedin(),
+                      'checked_out': pool.checkedout(),
+                      'overflow': pool.overflow(),
+                      'max_overflow': pool._max_overflow,
+                      'timeout': pool._timeout})
+    if isinstance(pool, StatsQueuePool):
+        stats.update({'waits': pool.waits,
+                      'wait_time': round(pool.wait_time, 6)})
+    return stats
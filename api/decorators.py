@@ -1,7 +1,19 @@
 import functools
 import hashlib
-from flask import jsonify, request, url_for, current_app, make_response, g
-from .rate_limit import RateLimit
+import math
+from flask import request, url_for, current_app, make_response, g, abort, \
+    stream_with_context
+from sqlalchemy import and_, or_, false, func, DateTime, Integer, String
+from sqlalchemy.orm import load_only, noload, joinedload, selectinload
+from .rate_limit import RateLimit, get_policy
+from .helpers import encode_cursor, decode_cursor, parse_datetime, \
+    INTEGER_TYPES, STRING_TYPES
+from .cache import LRUCache, get_cache, generation, model_namespace, \
+    shared_timeout
+from .database import replicas_lagging
+from .serializers import dumps, pretty_print, get_serializer
+from .profiling import timed
+from .metrics import RATE_LIMITED, RESPONSE_CACHE
 from .errors import too_many_requests, precondition_failed, not_modified, ValidationError
 
 
@@ -10,7 +22,11 @@ def json(f):
     a SQLAlchemy model."""
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
-        rv = f(*args, **kwargs)
+        with timed('view'):
+            rv = f(*args, **kwargs)
+        if isinstance(rv, current_app.response_class):
+            # the route generated its own response
+            return rv
         status_or_headers = None
         headers = None
         if isinstance(rv, tuple):
@@ -19,9 +35,14 @@ def json(f):
             headers, status_or_headers = status_or_headers, None
         if not isinstance(rv, dict):
             # assume it is a model, call its export_data() method
-            rv = rv.export_data()
+            with timed('export'):
+                rv = rv.export_data()
 
-        rv = jsonify(rv)
+        # the data is encoded directly with the configured serializer,
+        # without the copy and the indentation done by jsonify()
+        with timed('serialize'):
+            rv = current_app.response_class(dumps(rv),
+                                            mimetype='application/json')
         if status_or_headers is not None:
             rv.status_code = status_or_headers
         if headers is not None:
@@ -30,70 +51,415 @@ def json(f):
     return wrapped
 
 
-def rate_limit(limit, period):
-    """This decorator implements rate limiting."""
-    def decorator(f):
-        @functools.wraps(f)
-        def wrapped(*args, **kwargs):
-            if current_app.config['USE_RATE_LIMITS']:
-                # generate a unique key to represent the decorated function and
-                # the IP address of the client. Rate limiting counters are
-                # maintained on each unique key.
-                key = '{0}/{1}'.format(f.__name__, str(g.user.id))
-                limiter = RateLimit(key, limit, period)
-
-                # set the rate limit headers in g, so that they are picked up
-                # by the after_request handler and attached to the response
-                g.headers = {
-                    'X-RateLimit-Remaining': str(limiter.remaining
-                        if limiter.remaining >= 0 else 0),
-                    'X-RateLimit-Limit': str(limit),
-                    'X-RateLimit-Reset': str(limiter.reset)
-                }
-
-                # if the client went over the limit respond with a 429 status
-                # code, else invoke the wrapped function
-                if not limiter.allowed:
-                    return too_many_requests()
-
-            # let the request through
-            return f(*args, **kwargs)
-        return wrapped
-    return decorator
+def _check_rate_limit(cost=None):
+    """Charge the current request to the rate limit of the group of endpoints
+    it belongs to. The cost comes from the policy that matches the request,
+    unless it is given explicitly. Returns the error response to send to the
+    client if it went over the limit, or None otherwise."""
+    policy = get_policy(request.endpoint, request.method, g.user.tier)
+    if policy is None:
+        return None
+    group, limit, period, policy_cost = policy
+
+    # generate a unique key to represent the group of endpoints and the
+    # user. Rate limiting counters are maintained on each unique key.
+    key = '{0}/{1}'.format(group, str(g.user.id))
+    with timed('rate_limit'):
+        limiter = RateLimit(key, limit, period,
+                            policy_cost if cost is None else cost)
+
+    # set the rate limit headers in g, so that they are picked up by the
+    # after_request handler and attached to the response
+    g.headers = {
+        'X-RateLimit-Remaining': str(limiter.remaining
+            if limiter.remaining >= 0 else 0),
+        'X-RateLimit-Limit': str(limit),
+        'X-RateLimit-Reset': str(limiter.reset)
+    }
+
+    # if the client went over the limit respond with a 429 status code
+    if not limiter.allowed:
+        RATE_LIMITED.inc(group)
+        return too_many_requests()
+    return None
+
+
+def rate_limit(f):
+    """This decorator implements rate limiting. The limits are given by the
+    policy that matches the endpoint and method of the request and the tier
+    of the user."""
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        if current_app.config['USE_RATE_LIMITS']:
+            error = _check_rate_limit()
+            if error is not None:
+                return error
+
+        # let the request through
+        return f(*args, **kwargs)
+    return wrapped
+
+
+FILTER_OPERATORS = {'eq': '__eq__', 'ne': '__ne__', 'lt': '__lt__',
+                    'le': '__le__', 'gt': '__gt__', 'ge': '__ge__',
+                    'in': 'in_', 'like': 'like'}
 
 
-def _filter_query(model, query, filter_spec):
-    filters = [f.split(',') for f in filter_spec.split(';')]
-    for f in filters:
+def _spec_columns(model, attribute):
+    """Return the names of the columns of a model that can be used in filter
+    or sort specifications. Models can restrict them with the ``filterable``
+    and ``sortable`` attributes, otherwise all the columns are allowed."""
+    names = getattr(model, attribute, None)
+    if names is None:
+        names = model.__mapper__.columns.keys()
+    return names
+
+
+def _is_indexed(model, name):
+    """Return True if a column is the leading column of an index, so that
+    searching or sorting on it does not require a full table scan."""
+    column = model.__mapper__.columns[name]
+    if column.unique:
+        return True
+    table = column.table
+    leading = [list(index.columns)[0] for index in table.indexes]
+    leading += list(table.primary_key.columns)[:1]
+    return any(c is column for c in leading)
+
+
+def _compile_filter(model, filter_spec):
+    """Parse a filter specification into a list of (column name, operator,
+    value) tuples. Filters on columns that are not filterable and filters
+    with invalid operators are ignored. Returns the list of filters and a
+    flag that indicates if the filters require a full table scan."""
+    filters = []
+    full_scan = False
+    columns = _spec_columns(model, 'filterable')
+    for f in [f.split(',') for f in filter_spec.split(';')]:
         if len(f) < 3 or (len(f) > 3 and f[1] != 'in'):
             continue
         if f[1] == 'in':
             f = [f[0], f[1], f[2:]]
-        ops = {'eq': '__eq__', 'ne': '__ne__', 'lt': '__lt__', 'le': '__le__',
-               'gt': '__gt__', 'ge': '__ge__', 'in': 'in_', 'like': 'like'}
-        if hasattr(model, f[0]) and f[1] in ops.keys():
-            column = getattr(model, f[0])
-            op = ops[f[1]]
-            query = query.filter(getattr(column, op)(f[2]))
+        if f[0] in columns and f[1] in FILTER_OPERATORS:
+            filters.append((f[0], FILTER_OPERATORS[f[1]], f[2]))
+            if f[1] == 'like' and f[2][:1] in ['%', '_']:
+                # an index cannot be used when the pattern has a leading
+                # wildcard
+                full_scan = True
+    return filters, full_scan
+
+
+def _compile_sort(model, sort_spec):
+    """Parse a sort specification into a list of (column name, descending)
+    tuples. Columns that are not sortable are ignored. Returns the list and a
+    flag that indicates if the sort requires a full table scan."""
+    keys = []
+    columns = _spec_columns(model, 'sortable')
+    for s in [s.split(',') for s in sort_spec.split(';')]:
+        if s[0] in columns and s[0] not in [k[0] for k in keys]:
+            keys.append((s[0], len(s) == 2 and s[1] == 'desc'))
+    return keys, bool(keys) and not _is_indexed(model, keys[0][0])
+
+
+def _compiled_spec(compile, model, spec):
+    """Return a compiled filter or sort specification. Compiled
+    specifications are stored in an LRU cache, so the specifications of
+    frequent requests are only parsed once."""
+    if not spec:
+        return [], False
+    cache = current_app.extensions.get('query_specs')
+    if cache is None:
+        cache = LRUCache(current_app.config['QUERY_SPEC_CACHE_SIZE'],
+                         default_timeout=0)
+        current_app.extensions['query_specs'] = cache
+    key = (compile.__name__, model.__name__, spec)
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = compile(model, spec)
+        cache.set(key, compiled)
+    return compiled
+
+
+def _check_full_scan(model):
+    """Apply the FULL_SCAN_POLICY configuration to a request that requires a
+    full scan of the model's table. Small tables are always allowed. The
+    policy can be 'allow', 'reject' to respond with a 400 error, or 'cost' to
+    charge the request as FULL_SCAN_COST calls to the client's rate limit.
+    Returns the error response to send to the client, or None."""
+    config = current_app.config
+    policy = config['FULL_SCAN_POLICY']
+    if policy == 'allow' or \
+            _estimate_count(model, model.query) < config['FULL_SCAN_MIN_ROWS']:
+        return None
+    if policy == 'reject':
+        raise ValidationError('Filter or sort requires a full scan of the '
+                              'collection')
+    if not config['USE_RATE_LIMITS']:
+        return None
+    policy = get_policy(request.endpoint, request.method, g.user.tier)
+    if policy is None:
+        return None
+    cost = config['FULL_SCAN_COST']
+    # a request that costs more than the whole limit would never be
+    # allowed, so it is rejected as with the 'reject' policy
+    if cost > policy[1]:
+        raise ValidationError('Filter or sort requires a full scan of the '
+                              'collection')
+    # one call was already charged when the request was rate limited
+    if cost > 1:
+        return _check_rate_limit(cost - 1)
+    return None
+
+
+def _filter_query(model, query, filters):
+    for name, op, value in filters:
+        query = query.filter(getattr(getattr(model, name), op)(value))
     return query
 
 
-def _sort_query(model, query, sort_spec):
-    sort = [s.split(',') for s in sort_spec.split(';')]
-    for s in sort:
-        if hasattr(model, s[0]):
-            column = getattr(model, s[0])
-            if len(s) == 2 and s[1] in ['asc', 'desc']:
-                query = query.order_by(getattr(column, s[1])())
-            else:
-                query = query.order_by(column.asc())
+def _sort_query(model, query, keys):
+    for name, desc in keys:
+        column = getattr(model, name)
+        query = query.order_by(column.desc() if desc else column.asc())
     return query
 
 
+def _keyset_columns(model, sort_keys):
+    """Return the list of (attribute name, descending) tuples that define the
+    ordering used for keyset pagination. The columns given in the sort
+    specification are used first, followed by the primary key columns that
+    make the ordering unique."""
+    mapper = model.__mapper__
+    keys = list(sort_keys)
+    for column in mapper.primary_key:
+        name = mapper.get_property_by_column(column).key
+        if name not in [k[0] for k in keys]:
+            keys.append((name, False))
+    return keys
+
+
+def _cursor_value(column, value):
+    """Convert a value decoded from a cursor to the type of its column.
+    Raises ValueError if the value does not match the column."""
+    if value is None:
+        if not column.nullable:
+            raise ValueError('invalid cursor')
+        return None
+    if isinstance(column.type, DateTime):
+        if not isinstance(value, STRING_TYPES):
+            raise ValueError('invalid cursor')
+        return parse_datetime(value)
+    if isinstance(column.type, Integer):
+        valid = type(value) in INTEGER_TYPES
+    elif isinstance(column.type, String):
+        valid = isinstance(value, STRING_TYPES)
+    else:
+        valid = not isinstance(value, (list, dict))
+    if not valid:
+        raise ValueError('invalid cursor')
+    return value
+
+
+def _seek_clauses(column, value, desc):
+    """Return the clauses that select the rows that come after a value of a
+    column, and the rows that have the same value. NULLs are sorted after
+    all the other values in ascending order, so nullable columns get a
+    consistent order on all databases."""
+    if not column.nullable:
+        return (column < value if desc else column > value), column == value
+    if value is None:
+        return (column.isnot(None) if desc else false()), column.is_(None)
+    return (column < value if desc else or_(column > value,
+                                            column.is_(None))), \
+        column == value
+
+
+def _keyset_page(model, query, sort_keys, cursor, per_page):
+    """Return a page of results that starts after (or before, when going
+    backwards) the position given by the cursor. The position is located by
+    seeking on the ordering columns instead of using an offset, so that all
+    pages are equally expensive to retrieve."""
+    keys = _keyset_columns(model, sort_keys)
+    direction, values = 'next', None
+    if cursor:
+        try:
+            direction, values = decode_cursor(cursor)
+            if len(values) != len(keys):
+                raise ValueError('invalid cursor')
+            values = [_cursor_value(model.__mapper__.columns[name], value)
+                      for (name, desc), value in zip(keys, values)]
+        except (TypeError, ValueError):
+            raise ValidationError('Invalid cursor')
+    backwards = direction == 'prev'
+
+    for name, desc in keys:
+        column = getattr(model, name)
+        if model.__mapper__.columns[name].nullable:
+            # NULLs go last in ascending order, first in descending order
+            is_null = column.is_(None)
+            query = query.order_by(is_null.desc() if desc != backwards
+                                   else is_null.asc())
+        query = query.order_by(column.desc() if desc != backwards
+                               else column.asc())
+    if values is not None:
+        # (k1 > v1) or (k1 = v1 and k2 > v2) or ...
+        clauses = []
+        equal = []
+        for (name, desc), value in zip(keys, values):
+            after, same = _seek_clauses(model.__mapper__.columns[name],
+                                        value, desc != backwards)
+            clauses.append(and_(*(equal + [after])))
+            equal.append(same)
+        query = query.filter(or_(*clauses))
+
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    def cursor_for(item, direction):
+        return encode_cursor(direction, [getattr(item, name)
+                                         for name, desc in keys])
+
+    next_cursor = prev_cursor = None
+    if items:
+        if has_more or backwards:
+            next_cursor = cursor_for(items[-1], 'next')
+        if (has_more and backwards) or (values is not None and
+                                        not backwards):
+            prev_cursor = cursor_for(items[0], 'prev')
+    return items, prev_cursor, next_cursor
+
+
+def _estimate_count(model, query):
+    """Return the number of items in the query, using a cached count when
+    available. Cached counts are keyed by the SQL statement and its
+    parameters, and are discarded when the model's table is written to."""
+    statement = query.statement.compile()
+    digest = hashlib.md5((str(statement) + repr(sorted(
+        statement.params.items()))).encode('utf-8')).hexdigest()
+    key = 'count:{0}:{1}:{2}'.format(model.__tablename__,
+                                     generation(model.__tablename__), digest)
+    cache = get_cache()
+    total = cache.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        if not replicas_lagging():
+            cache.set(key, total, current_app.config['COUNT_CACHE_TIMEOUT'])
+    return total
+
+
+def _offset_page(query, page, per_page):
+    """Return the items in the requested page, and a flag that indicates if
+    there are more pages after it."""
+    if page < 1:
+        abort(404)
+    items = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    if not items and page != 1:
+        abort(404)
+    return items[:per_page], len(items) > per_page
+
+
+def _parse_expand(model, expand):
+    """Parse the expand argument of a collection request. Returns None if
+    the items are not expanded, or the list of related resources that are
+    expanded in each item, which can be empty."""
+    if not expand:
+        return None
+    names = [name for name in expand.split(',') if name and name != '1']
+    expandable = getattr(model, 'expandable', {})
+    for name in names:
+        if name not in expandable:
+            raise ValidationError('Invalid expand argument: ' + name)
+    return names
+
+
+def _expanded_models(model, names):
+    """Return the models of the related resources of a model that are
+    expanded with the given names. Names that cannot be expanded are
+    ignored."""
+    expandable = getattr(model, 'expandable', {})
+    return [getattr(model, expandable[name]).property.mapper.class_
+            for name in names if name in expandable]
+
+
+def _loader_options(model, sort_keys, expand, stream=False):
+    """Return the loader options for the items of a collection. Items that
+    are not expanded only need the columns used to build their URLs and
+    cursors, and none of their relationships. The related resources of
+    expanded items are loaded in batches, or joined when the items are
+    streamed, since batch loading cannot be combined with yield_per()."""
+    if expand is None:
+        return [load_only(*[name for name, desc
+                            in _keyset_columns(model, sort_keys)]),
+                noload('*')]
+    loader = joinedload if stream else selectinload
+    return [loader(getattr(model, model.expandable[name]))
+            for name in expand]
+
+
+def _wants_stream():
+    """Return True if the client asked for a streamed response."""
+    return request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson']) == \
+        'application/x-ndjson'
+
+
+def _stream_items(query, expand):
+    """Return a response that streams the items returned by a query as
+    newline delimited JSON. The rows are fetched from the database in
+    batches and each batch is sent as soon as it is encoded, so the memory
+    used does not depend on the number of items. The expand argument is
+    the list of related resources to expand in each item, or None to return
+    the URLs of the items."""
+    batch_size = current_app.config['STREAM_YIELD_PER']
+    encode = get_serializer()
+
+    def generate():
+        lines = []
+        for item in query.yield_per(batch_size):
+            lines.append(encode(item.export_data(expand)
+                                if expand is not None else item.get_url()))
+            if len(lines) == batch_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    return current_app.response_class(stream_with_context(generate()),
+                                      mimetype='application/x-ndjson')
+
+
+COLLECTION_ARGS = ['filter', 'sort', 'page', 'per_page', 'cursor', 'count',
+                   'expand']
+
+
 def collection(model, name=None, max_per_page=10):
     """This decorator implements pagination, filtering, sorting and expanding
     for collections. The expected response from the decorated route is a
-    SQLAlchemy query."""
+    SQLAlchemy query.
+
+    Collections are paginated by page number by default. If the request
+    includes a ``cursor`` argument, keyset pagination is used instead. Pass
+    an empty cursor to get the first page, then follow the ``next_url`` and
+    ``prev_url`` links. In this mode the total count is not reported.
+
+    With page numbers the ``count`` argument controls how the total is
+    obtained. It can be ``exact``, ``estimate`` to use a cached count, or
+    ``none`` to omit it.
+
+    The ``expand`` argument returns the items expanded instead of their
+    URLs. It can also be a comma separated list of related resources to
+    expand within each item, taken from the ``expandable`` attribute of the
+    model. Only the key columns of items that are not expanded are loaded.
+
+    Clients that send ``application/x-ndjson`` in the ``Accept`` header
+    receive the items of the requested page as a stream of newline delimited
+    JSON, without pagination metadata. Users in one of the tiers listed in
+    the EXPORT_TIERS configuration variable can request pages of up to
+    EXPORT_MAX_PER_PAGE items, which allows large collections to be exported
+    with a single streamed request."""
     if name is None:
         name = model.__tablename__
 
@@ -102,57 +468,189 @@ def collection(model, name=None, max_per_page=10):
         def wrapped(*args, **kwargs):
             query = f(*args, **kwargs)
 
+            # the arguments are recorded for the slow query log
+            g.collection_args = dict(
+                (arg, request.args[arg]) for arg in COLLECTION_ARGS
+                if arg in request.args)
+
             # filtering and sorting
             filter = request.args.get('filter')
-            if filter:
-                query = _filter_query(model, query, filter)
+            filters, filter_scan = _compiled_spec(_compile_filter, model,
+                                                  filter)
             sort = request.args.get('sort')
-            if sort:
-                query = _sort_query(model, query, sort)
+            sort_keys, sort_scan = _compiled_spec(_compile_sort, model, sort)
+            if filter_scan or sort_scan:
+                error = _check_full_scan(model)
+                if error is not None:
+                    return error
+            query = _filter_query(model, query, filters)
 
             # pagination
-            page = request.args.get('page', 1, type=int)
+            page_limit = max_per_page
+            if g.user.tier in current_app.config['EXPORT_TIERS']:
+                page_limit = max(page_limit,
+                                 current_app.config['EXPORT_MAX_PER_PAGE'])
             per_page = min(request.args.get('per_page', max_per_page,
-                                            type=int), max_per_page)
+                                            type=int), page_limit)
             expand = request.args.get('expand')
+            expand_names = _parse_expand(model, expand)
+            cursor = request.args.get('cursor')
 
-            p = query.paginate(page, per_page)
-            pages = {'page': page, 'per_page': per_page,
-                     'total': p.total, 'pages': p.pages}
-            if p.has_prev:
-                pages['prev_url'] = url_for(request.endpoint, page=p.prev_num,
-                                            per_page=per_page,
-                                            expand=expand, _external=True,
-                                            **kwargs)
-            else:
-                pages['prev_url'] = None
-            if p.has_next:
-                pages['next_url'] = url_for(request.endpoint, filter=filter,
-                                            sort=sort, page=p.next_num,
-                                            per_page=per_page,
-                                            expand=expand, _external=True,
-                                            **kwargs)
-            else:
-                pages['next_url'] = None
-            pages['first_url'] = url_for(request.endpoint, filter=filter,
-                                         sort=sort, page=1, per_page=per_page,
-                                         expand=expand, _external=True,
-                                         **kwargs)
-            pages['last_url'] = url_for(request.endpoint, filter=filter,
-                                        sort=sort, page=p.pages,
-                                        per_page=per_page, expand=expand,
-                                        _external=True, **kwargs)
-            if expand:
-                items = [item.export_data() for item in p.items]
+            if _wants_stream():
+                if cursor is not None:
+                    raise ValidationError('Cursors are not supported in '
+                                          'streamed collections')
+                query = _sort_query(model, query, sort_keys)
+                page = request.args.get('page', 1, type=int)
+                if page < 1:
+                    abort(404)
+                query = query.options(*_loader_options(
+                    model, sort_keys, expand_names, stream=True))
+                return _stream_items(
+                    query.limit(per_page).offset((page - 1) * per_page),
+                    expand_names)
+
+            def page_url(**page_args):
+                url_args = dict(kwargs)
+                url_args.update(page_args)
+                return url_for(request.endpoint, filter=filter, sort=sort,
+                               per_page=per_page, expand=expand,
+                               _external=True, **url_args)
+
+            options = _loader_options(model, sort_keys, expand_names)
+            if cursor is not None:
+                with timed('paginate'):
+                    items, prev_cursor, next_cursor = _keyset_page(
+                        model, query.options(*options), sort_keys, cursor,
+                        per_page)
+                pages = {'per_page': per_page,
+                         'prev_url': page_url(cursor=prev_cursor)
+                         if prev_cursor else None,
+                         'next_url': page_url(cursor=next_cursor)
+                         if next_cursor else None,
+                         'first_url': page_url(cursor='')}
             else:
-                items = [item.get_url() for item in p.items]
+                query = _sort_query(model, query, sort_keys)
+                page = request.args.get('page', 1, type=int)
+                count = request.args.get('count')
+                if count in ['exact', 'estimate', 'none']:
+                    count_mode = count
+                else:
+                    count, count_mode = None, \
+                        current_app.config['DEFAULT_COUNT_MODE']
+                total = None
+                with timed('count'):
+                    if count_mode == 'exact':
+                        if hasattr(model, 'updated_at'):
+                            # get the total and the last modification time
+                            # of the collection in a single query, and use
+                            # them as the collection's version
+                            total, updated_at = query.order_by(None) \
+                                .with_entities(
+                                    func.count(),
+                                    func.max(model.updated_at)).one()
+                            version = [total, updated_at]
+                            # expanded related resources are part of the
+                            # representation, so their changes are as well
+                            for related_name in expand_names or []:
+                                relationship = getattr(
+                                    model, model.expandable[related_name])
+                                related = _expanded_models(
+                                    model, [related_name])[0]
+                                version.append(query.order_by(None)
+                                               .join(relationship)
+                                               .with_entities(func.max(
+                                                   related.updated_at))
+                                               .scalar())
+                            error = _check_version(*version)
+                            if error is not None:
+                                return error
+                        else:
+                            total = query.order_by(None).count()
+                    elif count_mode == 'estimate':
+                        total = _estimate_count(model, query)
+                with timed('paginate'):
+                    items, has_next = _offset_page(query.options(*options),
+                                                   page, per_page)
+                pages = {'page': page, 'per_page': per_page}
+                if page > 1:
+                    pages['prev_url'] = page_url(page=page - 1, count=count)
+                else:
+                    pages['prev_url'] = None
+                if has_next:
+                    pages['next_url'] = page_url(page=page + 1, count=count)
+                else:
+                    pages['next_url'] = None
+                pages['first_url'] = page_url(page=1, count=count)
+                if total is not None:
+                    pages['total'] = total
+                    pages['pages'] = int(math.ceil(total / float(per_page))) \
+                        if per_page else 0
+                    pages['last_url'] = page_url(page=pages['pages'],
+                                                 count=count)
+            with timed('export'):
+                if expand_names is not None:
+                    items = [item.export_data(expand_names)
+                             for item in items]
+                else:
+                    items = [item.get_url() for item in items]
             return {name: items, 'meta': pages}
         return wrapped
     return decorator
 
 
+def _check_preconditions(etag):
+    """Evaluate the If-Match and If-None-Match headers of the request against
+    the given ETag. Returns the error response to send to the client if a
+    precondition fails, or None otherwise."""
+    if_match = request.headers.get('If-Match')
+    if_none_match = request.headers.get('If-None-Match')
+    if if_match:
+        etag_list = [tag.strip() for tag in if_match.split(',')]
+        if etag not in etag_list and '*' not in etag_list:
+            return precondition_failed()
+    elif if_none_match:
+        etag_list = [tag.strip() for tag in if_none_match.split(',')]
+        if etag in etag_list or '*' in etag_list:
+            return not_modified()
+    return None
+
+
+def _check_version(*version):
+    """Generate the ETag for the current request from the version of the
+    resources it returns, so that conditional requests can be evaluated
+    before the response is generated. Returns the error response to send to
+    the client if a precondition fails, or None otherwise."""
+    # indented and compact responses are different representations
+    with timed('etag'):
+        g.etag = '"' + hashlib.md5('|'.join(
+            [request.url, str(int(pretty_print()))] +
+            [str(v) for v in version]).encode('utf-8')).hexdigest() + '"'
+    return _check_preconditions(g.etag)
+
+
+def versioned(model):
+    """This decorator generates the ETag of a single resource from its last
+    modification time, so that conditional requests are answered without
+    invoking the route. The arguments of the route must be the primary key
+    of the resource, and the route must use @etag."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            updated_at = model.query.with_entities(model.updated_at) \
+                .filter_by(**kwargs).scalar()
+            if updated_at is not None:
+                error = _check_version(updated_at)
+                if error is not None:
+                    return error
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
 def etag(f):
-    """This decorator adds an ETag header to the response."""
+    """This decorator adds an ETag header to the response. If the route did
+    not set a version ETag the ETag is a hash of the response body."""
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
         # only for HEAD and GET requests
@@ -160,18 +658,81 @@ def etag(f):
             '@etag is only supported for GET requests'
         rv = f(*args, **kwargs)
         rv = make_response(rv)
-        etag = '"' + hashlib.md5(rv.get_data()).hexdigest() + '"'
+        etag = g.get('etag')
+        if etag is None:
+            if rv.is_streamed:
+                # hashing the body would consume the stream
+                return rv
+            with timed('etag'):
+                etag = '"' + hashlib.md5(rv.get_data()).hexdigest() + '"'
+            error = _check_preconditions(etag)
+            if error is not None:
+                return error
         rv.headers['Cache-Control'] = 'max-age=86400'
         rv.headers['ETag'] = etag
-        if_match = request.headers.get('If-Match')
-        if_none_match = request.headers.get('If-None-Match')
-        if if_match:
-            etag_list = [tag.strip() for tag in if_match.split(',')]
-            if etag not in etag_list and '*' not in etag_list:
-                rv = precondition_failed()
-        elif if_none_match:
-            etag_list = [tag.strip() for tag in if_none_match.split(',')]
-            if etag in etag_list or '*' in etag_list:
-                rv = not_modified()
         return rv
     return wrapped
+
+
+def cached(*models):
+    """This decorator stores the responses of GET requests in the server-side
+    cache, and serves subsequent requests for the same URL and user without
+    invoking the route. The response is discarded when any of the given
+    models changes. When the arguments of the route match the primary key of
+    a model only changes to that resource are considered. Responses that
+    expand related resources are also discarded when the related models
+    change. The decorated route must use @etag."""
+    pk_names = []
+    for model in models:
+        mapper = model.__mapper__
+        pk_names.append([mapper.get_property_by_column(c).key
+                         for c in mapper.primary_key])
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            if not current_app.config['USE_RESPONSE_CACHE'] or \
+                    _wants_stream():
+                return f(*args, **kwargs)
+
+            generations = []
+            for model, names in zip(models, pk_names):
+                if sorted(kwargs.keys()) == sorted(names):
+                    namespace = model_namespace(
+                        model, *[kwargs[name] for name in names])
+                else:
+                    namespace = model_namespace(model)
+                generations.append(generation(namespace))
+            # responses with expanded related resources are also discarded
+            # when the related models change
+            expand = request.args.get('expand')
+            if expand:
+                for model in models:
+                    for related in _expanded_models(model, expand.split(',')):
+                        generations.append(generation(
+                            model_namespace(related)))
+            key = 'response:{0}:{1}:{2}:{3}'.format(
+                ':'.join(generations), g.user.id, int(pretty_print()),
+                hashlib.md5(request.url.encode('utf-8')).hexdigest())
+            cache = get_cache()
+            hit = cache.get(key)
+            if hit is None:
+                RESPONSE_CACHE.inc('miss')
+                rv = f(*args, **kwargs)
+                if rv.status_code == 200 and not replicas_lagging():
+                    cache.set(key, (rv.get_data(), rv.headers['ETag']),
+                              shared_timeout(current_app.config[
+                                  'RESPONSE_CACHE_TIMEOUT']))
+                return rv
+
+            RESPONSE_CACHE.inc('hit')
+            body, etag = hit
+            rv = current_app.response_class(body, mimetype='application/json')
+            rv.headers['Cache-Control'] = 'max-age=86400'
+            rv.headers['ETag'] = etag
+            error = _check_preconditions(etag)
+            if error is not None:
+                return error
+            return rv
+        return wrapped
+    return decorator
@@ -1,3 +1,8 @@
+import base64
+import json
+import re
+from datetime import datetime
+from flask import url_for
 from flask.globals import _app_ctx_stack, _request_ctx_stack
 from werkzeug.urls import url_parse
 from werkzeug.exceptions import NotFound
@@ -32,3 +37,102 @@ def args_from_url(url, endpoint):
     if r[0] != endpoint:
         raise NotFound()
     return r[1]
+
+
+def encode_cursor(direction, values):
+    """Encode a position in a keyset paginated collection as an opaque
+    string that can be safely included in a URL."""
+    data = [direction] + [v.isoformat() if isinstance(v, datetime) else v
+                          for v in values]
+    cursor = base64.urlsafe_b64encode(
+        json.dumps(data, separators=(',', ':')).encode('utf-8'))
+    return cursor.decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor generated by encode_cursor(). Returns a tuple with the
+    direction and the list of key values. Raises ValueError if the cursor is
+    invalid."""
+    try:
+        cursor = cursor.encode('utf-8')
+        cursor += b'=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(cursor).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(data, list) or len(data) < 2 or \
+            data[0] not in ['next', 'prev']:
+        raise ValueError('invalid cursor')
+    return data[0], data[1:]
+
+
+def parse_datetime(value):
+    """Parse a datetime in the format generated by datetime.isoformat()."""
+    for fmt in ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('invalid datetime')
+
+
+# values that are unlikely to appear in a URL, used to find the position of
+# the arguments in the URL templates
+URL_PLACEHOLDER = 9081726354
+MAX_URL_TEMPLATES = 1000
+try:
+    INTEGER_TYPES = frozenset([int, long])
+except NameError:  # pragma: no cover
+    INTEGER_TYPES = frozenset([int])
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:  # pragma: no cover
+    STRING_TYPES = (str,)
+
+
+def _url_template(endpoint, names):
+    placeholders = dict((str(URL_PLACEHOLDER + i), name)
+                        for i, name in enumerate(names))
+    url = url_for(endpoint, _external=True,
+                  **dict((name, int(p)) for p, name in placeholders.items()))
+    parts = re.split('(' + '|'.join(placeholders) + ')', url)
+    if sorted(parts[1::2]) != sorted(placeholders):
+        # the URL cannot be built by replacing the arguments
+        return None
+    template = ''
+    for i, part in enumerate(parts):
+        if i % 2:
+            template += '{' + placeholders[part] + '}'
+        else:
+            template += part.replace('{', '{{').replace('}', '}}')
+    return template
+
+
+def build_url(endpoint, **values):
+    """Return the external URL of an endpoint, like url_for() with
+    _external=True. The URL of each endpoint is built by the routing system
+    only once, and then stored as a template in which the integer arguments
+    are inserted, which is much faster when building URLs for many
+    resources. Arguments of other types are passed to url_for()."""
+    # this function is called several times for each item in a collection,
+    # so the request context is accessed directly instead of through the
+    # context local proxies
+    reqctx = _request_ctx_stack.top
+    if reqctx is None:
+        return url_for(endpoint, _external=True, **values)
+    for value in values.values():
+        if type(value) not in INTEGER_TYPES:
+            return url_for(endpoint, _external=True, **values)
+    key = (endpoint, tuple(sorted(values)), reqctx.request.url_root)
+    templates = reqctx.app.extensions.setdefault('url_templates', {})
+    try:
+        template = templates[key]
+    except KeyError:
+        template = _url_template(endpoint, key[1])
+        if len(templates) >= MAX_URL_TEMPLATES:
+            # the key includes the host sent by the client, so the number
+            # of templates needs to be limited
+            templates.clear()
+        templates[key] = template
+    if template is None:
+        return url_for(endpoint, _external=True, **values)
+    return template.format(**values)
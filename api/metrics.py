@@ -0,0 +1,223 @@
+"""Metrics in the Prometheus text format.
+
+Counters and histograms are recorded without locks. Each thread records in
+its own shard, which is only written by that thread, and the shards are
+merged when the metrics are collected. Shards are keyed by the identity of
+the thread, so a thread that replaces one that ended reuses its shard. With
+gevent all the greenlets of a thread share its shard, which is safe because
+greenlets do not switch while they record."""
+import bisect
+import threading
+import time
+from flask import current_app, request, g, _app_ctx_stack
+from .database import pool_stats
+from .profiling import DURATION_BUCKETS
+try:
+    import _thread as thread
+except ImportError:  # pragma: no cover
+    import thread
+try:
+    # shards belong to the real threads, not to the greenlets that gevent
+    # patches in
+    from gevent.monkey import get_original
+    get_ident = get_original(thread.__name__, 'get_ident')
+except ImportError:  # pragma: no cover
+    get_ident = thread.get_ident
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels):
+        """Increment the counter for the given label values."""
+        shard = _get_shard()
+        if shard is not None:
+            key = (self.name, labels)
+            shard[key] = shard.get(key, 0) + 1
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(),
+                 buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        """Record a value for the given label values."""
+        shard = _get_shard()
+        if shard is not None:
+            key = (self.name, labels)
+            entry = shard.get(key)
+            if entry is None:
+                # the count of each bucket, followed by the sum of the values
+                entry = shard[key] = [0] * (len(self.buckets) + 2)
+            entry[bisect.bisect_left(self.buckets, value)] += 1
+            entry[-1] += value
+
+
+REQUESTS = Counter('api_requests_total',
+                   'Requests handled, by endpoint, method and status code.',
+                   ['endpoint', 'method', 'status'])
+REQUEST_DURATION = Histogram('api_request_duration_seconds',
+                             'Duration of the requests, by endpoint.',
+                             ['endpoint'])
+RATE_LIMITED = Counter('api_rate_limited_total',
+                       'Requests rejected by the rate limits, by group.',
+                       ['group'])
+AUTH_CACHE = Counter('api_auth_cache_total',
+                     'Lookups of users and credentials in the cache.',
+                     ['cache', 'result'])
+RESPONSE_CACHE = Counter('api_response_cache_total',
+                         'Lookups of responses in the cache.', ['result'])
+METRICS = [REQUESTS, REQUEST_DURATION, RATE_LIMITED, AUTH_CACHE,
+           RESPONSE_CACHE]
+
+
+class Metrics(object):
+    """Values of the metrics recorded by an application."""
+    def __init__(self):
+        self.shards = {}
+        self.lock = threading.Lock()
+
+    def shard(self):
+        ident = get_ident()
+        shard = self.shards.get(ident)
+        if shard is None:
+            with self.lock:
+                shard = self.shards[ident] = {}
+        return shard
+
+    def collect(self):
+        """Merge the shards, and return the values of the metrics keyed by
+        (name, labels)."""
+        values = {}
+        for shard in list(self.shards.values()):
+            for key, value in list(shard.items()):
+                if isinstance(value, list):
+                    total = values.get(key)
+                    if total is None:
+                        values[key] = list(value)
+                    else:
+                        values[key] = [a + b for a, b in zip(total, value)]
+                else:
+                    values[key] = values.get(key, 0) + value
+        return values
+
+
+def get_metrics(app=None):
+    """Return the metrics of the given application, or of the current
+    application if no application is given."""
+    if app is None:
+        app = current_app._get_current_object()
+    metrics = app.extensions.get('metrics')
+    if metrics is None:
+        metrics = app.extensions['metrics'] = Metrics()
+    return metrics
+
+
+def _get_shard():
+    # the application is taken from the context stack directly, as going
+    # through the current_app proxy would dominate the cost of recording
+    app = _app_ctx_stack.top.app
+    if not app.config['USE_METRICS']:
+        return None
+    return get_metrics(app).shard()
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')) for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _pool_metrics(engine):
+    stats = pool_stats(engine)
+    if 'size' not in stats:
+        return []
+    lines = ['# HELP api_db_pool_connections Connections of the database '
+             'pool, by state.',
+             '# TYPE api_db_pool_connections gauge']
+    for state in ['size', 'checked_in', 'checked_out', 'overflow']:
+        lines.append('api_db_pool_connections{{state="{0}"}} {1}'.format(
+            state, stats[state]))
+    if 'waits' in stats:
+        lines += ['# HELP api_db_pool_waits_total Checkouts that waited for '
+                  'a connection.',
+                  '# TYPE api_db_pool_waits_total counter',
+                  'api_db_pool_waits_total {0}'.format(stats['waits']),
+                  '# HELP api_db_pool_wait_seconds_total Time spent waiting '
+                  'for connections.',
+                  '# TYPE api_db_pool_wait_seconds_total counter',
+                  'api_db_pool_wait_seconds_total {0}'.format(
+                      _format_value(float(stats['wait_time'])))]
+    return lines
+
+
+def generate_metrics(engine):
+    """Return the metrics of the current application and the state of the
+    pool of the given engine, in the Prometheus text format."""
+    values = get_metrics().collect()
+    lines = []
+    for metric in METRICS:
+        lines.append('# HELP {0} {1}'.format(metric.name, metric.description))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+        for (name, labels), value in sorted(values.items()):
+            if name != metric.name:
+                continue
+            if metric.type == 'counter':
+                lines.append('{0}{1} {2}'.format(
+                    name, _format_labels(metric.labels, labels),
+                    _format_value(value)))
+                continue
+            count = 0
+            for bound, bucket in zip(metric.buckets + ['+Inf'], value[:-1]):
+                count += bucket
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, _format_labels(metric.labels + ('le',),
+                                         labels + (bound,)), count))
+            label_text = _format_labels(metric.labels, labels)
+            lines.append('{0}_sum{1} {2}'.format(name, label_text,
+                                                 _format_value(value[-1])))
+            lines.append('{0}_count{1} {2}'.format(name, label_text, count))
+    lines += _pool_metrics(engine)
+    return '\n'.join(lines) + '\n'
+
+
+def start_request():
+    if current_app.config['USE_METRICS']:
+        g.request_start = time.time()
+
+
+def record_request(response):
+    start = g.get('request_start')
+    if start is not None:
+        endpoint = request.endpoint or '<unmatched>'
+        REQUESTS.inc(endpoint, request.method, response.status_code)
+        REQUEST_DURATION.observe(time.time() - start, endpoint)
+    return response
+
+
+def init_app(app):
+    """Install the request handlers that record the request metrics of the
+    application."""
+    app.before_request(start_request)
+    app.after_request(record_request)
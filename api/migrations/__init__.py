@@ -0,0 +1,96 @@
+"""Database schema migrations.
+
+Each migration is a module in this package named ``v<NNN>_<description>``,
+where ``NNN`` is the version of the schema that the migration upgrades to.
+Migration modules implement ``upgrade(connection)`` and
+``downgrade(connection)`` functions. The version of a database is stored in
+the ``schema_version`` table.
+
+Migrations run in a transaction, unless the module sets ``transactional`` to
+False. Non-transactional migrations manage their own transactions, which
+allows them to create indexes concurrently and to backfill large tables in
+batches with the functions in the ``operations`` module. They must be safe
+to run again if they are interrupted.
+"""
+import importlib
+import os
+import pkgutil
+import re
+import sys
+from sqlalchemy import Table, Column, Integer, MetaData
+
+metadata = MetaData()
+schema_version = Table('schema_version', metadata,
+                       Column('version', Integer, nullable=False))
+
+
+def get_migrations():
+    """Return the list of available migrations, as (version, module) tuples
+    sorted by version."""
+    migrations = []
+    for _, name, _ in pkgutil.iter_modules([os.path.dirname(__file__)]):
+        match = re.match(r'^v(\d+)_', name)
+        if match:
+            migrations.append((int(match.group(1)),
+                               importlib.import_module('.' + name,
+                                                       __name__)))
+    return sorted(migrations, key=lambda m: m[0])
+
+
+def current_version(engine):
+    """Return the schema version of the database, or 0 if the database has
+    not been migrated."""
+    if not engine.has_table(schema_version.name):
+        return 0
+    return engine.execute(schema_version.select()).scalar() or 0
+
+
+def _set_version(connection, version):
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+
+def _run(engine, f, version):
+    # run a migration function and record the new version of the schema
+    if getattr(sys.modules[f.__module__], 'transactional', True):
+        with engine.begin() as connection:
+            f(connection)
+            _set_version(connection, version)
+    else:
+        connection = engine.connect()
+        try:
+            f(connection)
+            with connection.begin():
+                _set_version(connection, version)
+        finally:
+            connection.close()
+
+
+def upgrade(engine, target=None):
+    """Upgrade the database to the target version, or to the latest version
+    if no target is given. Each migration runs in its own transaction.
+    Returns the list of versions that were applied."""
+    metadata.create_all(engine)
+    version = current_version(engine)
+    applied = []
+    for v, migration in get_migrations():
+        if v <= version or (target is not None and v > target):
+            continue
+        _run(engine, migration.upgrade, v)
+        applied.append(v)
+    return applied
+
+
+def downgrade(engine, target):
+    """Downgrade the database to the target version, undoing the migrations
+    above it in reverse order. Returns the list of versions that were
+    reverted."""
+    version = current_version(engine)
+    reverted = []
+    migrations = get_migrations()
+    for i, (v, migration) in reversed(list(enumerate(migrations))):
+        if v > version or v <= target:
+            continue
+        _run(engine, migration.downgrade, migrations[i - 1][0] if i else 0)
+        reverted.append(v)
+    return reverted
@@ -0,0 +1,116 @@
+"""Schema operations for migrations that run while the application is
+serving requests.
+
+The operations check the current state of the database before changing it,
+so migrations can be applied to databases that were created with
+``db.create_all()``, and migrations that were interrupted can be run again.
+Operations that modify large tables are done in ways that do not lock the
+table for the duration of the change."""
+from sqlalchemy import inspect, select, and_, or_, func, bindparam
+
+
+def _quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def has_index(connection, table, name):
+    return name in [index['name'] for index in
+                    inspect(connection).get_indexes(table)]
+
+
+def has_column(connection, table, name):
+    return name in [column['name'] for column in
+                    inspect(connection).get_columns(table)]
+
+
+def create_index(connection, table, name, columns):
+    """Create an index if it does not exist. On PostgreSQL the index is
+    created concurrently, so writes to the table are not blocked, which
+    requires the migration to be non-transactional."""
+    if has_index(connection, table, name):
+        return
+    if connection.dialect.name != 'postgresql':
+        connection.execute('CREATE INDEX {0} ON {1} ({2})'.format(
+            _quote(connection, name), _quote(connection, table),
+            ', '.join(_quote(connection, column) for column in columns)))
+        return
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block, so it
+    # is issued on a separate connection in autocommit mode. The isolation
+    # level is reset when the connection is returned to the pool
+    autocommit = connection.engine.connect().execution_options(
+        isolation_level='AUTOCOMMIT')
+    try:
+        autocommit.execute('CREATE INDEX CONCURRENTLY {0} ON {1} ({2})'.format(
+            _quote(connection, name), _quote(connection, table),
+            ', '.join(_quote(connection, column) for column in columns)))
+    finally:
+        autocommit.close()
+
+
+def drop_index(connection, table, name):
+    if not has_index(connection, table, name):
+        return
+    if connection.dialect.name == 'mysql':
+        connection.execute('DROP INDEX {0} ON {1}'.format(
+            _quote(connection, name), _quote(connection, table)))
+    else:
+        connection.execute('DROP INDEX {0}'.format(_quote(connection, name)))
+
+
+def add_column(connection, table, column):
+    """Add a column if it does not exist. The column must be nullable and
+    have no server default, so that databases can add it without rewriting
+    the table. Existing rows can then be populated with backfill()."""
+    assert column.nullable and column.server_default is None, \
+        'columns must be added as nullable and without a server default'
+    if has_column(connection, table, column.name):
+        return
+    connection.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+        _quote(connection, table), _quote(connection, column.name),
+        column.type.compile(dialect=connection.dialect)))
+
+
+def drop_column(connection, table, name):
+    if not has_column(connection, table, name):
+        return
+    connection.execute('ALTER TABLE {0} DROP COLUMN {1}'.format(
+        _quote(connection, table), _quote(connection, name)))
+
+
+def _after(columns, values):
+    # (c1 > v1) or (c1 = v1 and c2 > v2) or ...
+    return or_(*[and_(*([c == v for c, v in zip(columns[:i], values[:i])] +
+                        [columns[i] > values[i]]))
+                 for i in range(len(columns))])
+
+
+def backfill(connection, table, column, value, default=None,
+             batch_size=1000):
+    """Set the value of a column in all the rows of a table where it is
+    NULL. The rows are updated in batches, each in its own transaction, so
+    that the table is never locked for long. The value can be a constant or
+    a SQL expression, and rows where the expression is NULL get the default
+    instead. The table is walked in primary key order, so each row is only
+    visited once. Returns the number of rows updated."""
+    pk = list(table.primary_key.columns)
+    if default is not None:
+        value = func.coalesce(value, default)
+    update = table.update().where(and_(*[
+        c == bindparam('_pk_' + c.name) for c in pk] + [column.is_(None)])) \
+        .values({column.name: value})
+    query = select(pk).where(column.is_(None)).order_by(*pk).limit(batch_size)
+    total = 0
+    last = None
+    while True:
+        with connection.begin():
+            rows = connection.execute(
+                query if last is None else query.where(_after(pk, last))) \
+                .fetchall()
+            if not rows:
+                break
+            connection.execute(update, [
+                dict(('_pk_' + c.name, row[i]) for i, c in enumerate(pk))
+                for row in rows])
+        total += len(rows)
+        last = list(rows[-1])
+    return total
@@ -0,0 +1,40 @@
+"""Initial schema, as created by ``manage.py createdb`` before migrations
+were introduced."""
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, \
+    ForeignKey, Index
+
+metadata = MetaData()
+
+students = Table(
+    'students', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(64)),
+    Index('ix_students_name', 'name'))
+
+classes = Table(
+    'classes', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(64)),
+    Index('ix_classes_name', 'name'))
+
+registrations = Table(
+    'registrations', metadata,
+    Column('student_id', Integer, ForeignKey('students.id'),
+           primary_key=True),
+    Column('class_id', Integer, ForeignKey('classes.id'), primary_key=True),
+    Column('timestamp', DateTime))
+
+users = Table(
+    'users', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(64)),
+    Column('password_hash', String(128)),
+    Index('ix_users_username', 'username'))
+
+
+def upgrade(connection):
+    metadata.create_all(connection)
+
+
+def downgrade(connection):
+    metadata.drop_all(connection)
@@ -0,0 +1,23 @@
+"""Indexes on the class_id and timestamp columns of registrations.
+
+The primary key of registrations starts with student_id, so it cannot be
+used to find the registrations of a class, which is needed to list them and
+to delete them when the class is deleted. Listings sorted by timestamp also
+had to scan and sort the whole table."""
+from .operations import create_index, drop_index
+
+# indexes are created concurrently where supported
+transactional = False
+
+indexes = [('ix_registrations_class_id', ['class_id']),
+           ('ix_registrations_timestamp', ['timestamp'])]
+
+
+def upgrade(connection):
+    for name, columns in indexes:
+        create_index(connection, 'registrations', name, columns)
+
+
+def downgrade(connection):
+    for name, columns in indexes:
+        drop_index(connection, 'registrations', name)
@@ -0,0 +1,51 @@
+"""Last modification times of students, classes and registrations, and
+rate limit tiers of users.
+
+The columns are added as nullable and then populated in batches, so the
+tables are not locked while existing rows are updated. The modification
+time of registrations starts as their timestamp, and the modification time
+of students and classes as the time of the migration."""
+from datetime import datetime
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData
+from .operations import add_column, drop_column, backfill
+
+transactional = False
+
+metadata = MetaData()
+
+students = Table('students', metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('updated_at', DateTime))
+
+classes = Table('classes', metadata,
+                Column('id', Integer, primary_key=True),
+                Column('updated_at', DateTime))
+
+registrations = Table('registrations', metadata,
+                      Column('student_id', Integer, primary_key=True),
+                      Column('class_id', Integer, primary_key=True),
+                      Column('timestamp', DateTime),
+                      Column('updated_at', DateTime))
+
+users = Table('users', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('tier', String(16)))
+
+
+def upgrade(connection):
+    for table in [students, classes, registrations]:
+        add_column(connection, table.name, table.c.updated_at)
+    add_column(connection, users.name, users.c.tier)
+
+    now = datetime.utcnow()
+    backfill(connection, students, students.c.updated_at, now)
+    backfill(connection, classes, classes.c.updated_at, now)
+    backfill(connection, registrations, registrations.c.updated_at,
+             registrations.c.timestamp, default=now)
+    backfill(connection, users, users.c.tier, 'default')
+
+
+def downgrade(connection):
+    for table in [students, classes, registrations]:
+        drop_column(connection, table.name, 'updated_at')
+    drop_column(connection, users.name, 'tier')
@@ -1,67 +1,142 @@
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.exceptions import NotFound
-from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from flask import url_for, current_app
-from flask_sqlalchemy import SQLAlchemy
-from .helpers import args_from_url
+from .database import Database
+from .helpers import args_from_url, build_url, STRING_TYPES
+from .signing import get_token_signer
+from .passwords import hash_password, check_password
 from .errors import ValidationError
 
-db = SQLAlchemy()
+db = Database()
+
+
+class Resolver(object):
+    """Resolves resource URLs to model instances. Instances can be preloaded
+    in batches, with a single query per model. Instances that are already in
+    the session are returned without querying the database."""
+    batch_size = 500
+
+    def __init__(self):
+        self.ids = {}
+        self.objects = {}
+
+    def get_id(self, endpoint, url):
+        if not isinstance(url, STRING_TYPES):
+            # URLs given as numbers, lists or objects are invalid
+            return None
+        if (endpoint, url) not in self.ids:
+            try:
+                self.ids[(endpoint, url)] = args_from_url(url, endpoint)['id']
+            except NotFound:
+                self.ids[(endpoint, url)] = None
+        return self.ids[(endpoint, url)]
+
+    def preload(self, model, endpoint, urls):
+        ids = set([self.get_id(endpoint, url) for url in urls])
+        ids.discard(None)
+        ids = list(ids)
+        for id in ids:
+            self.objects[(model, id)] = None
+        # the ids are queried in batches to stay below the limit that some
+        # databases have on the number of parameters in a statement
+        for i in range(0, len(ids), self.batch_size):
+            for obj in model.query.filter(
+                    model.id.in_(ids[i:i + self.batch_size])):
+                self.objects[(model, obj.id)] = obj
+
+    def get(self, model, endpoint, url):
+        id = self.get_id(endpoint, url)
+        if id is None:
+            return None
+        if (model, id) not in self.objects:
+            # query.get() looks in the session's identity map first
+            self.objects[(model, id)] = model.query.get(id)
+        return self.objects[(model, id)]
 
 
 class Registration(db.Model):
     __tablename__ = 'registrations'
+    filterable = ['student_id', 'class_id', 'timestamp']
+    sortable = ['student_id', 'class_id', 'timestamp']
+    # related resources that can be expanded in collections, mapped to
+    # their relationships
+    expandable = {'student': 'student', 'class': 'class_'}
     student_id = db.Column('student_id', db.Integer,
                            db.ForeignKey('students.id'), primary_key=True)
     class_id = db.Column('class_id', db.Integer,
-                         db.ForeignKey('classes.id'), primary_key=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+                         db.ForeignKey('classes.id'), primary_key=True,
+                         index=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
 
     def get_url(self):
-        return url_for('api.get_registration', student_id=self.student_id,
-                       class_id=self.class_id, _external=True)
-
-    def export_data(self):
-        return {'self_url': self.get_url(),
-                'student_url': url_for('api.get_student', id=self.student_id,
-                                       _external=True),
-                'class_url': url_for('api.get_class', id=self.class_id,
-                                     _external=True),
+        return build_url('api.get_registration', student_id=self.student_id,
+                         class_id=self.class_id)
+
+    def export_data(self, expand=()):
+        data = {'self_url': self.get_url(),
+                'student_url': build_url('api.get_student',
+                                         id=self.student_id),
+                'class_url': build_url('api.get_class', id=self.class_id),
                 'timestamp': self.timestamp.isoformat() + 'Z'}
+        for name in expand:
+            data[name] = getattr(self, self.expandable[name]).export_data()
+        return data
 
-    def import_data(self, data):
+    def import_data(self, data, resolver=None):
+        if resolver is None:
+            resolver = Resolver()
         try:
-            student_id = args_from_url(data['student_url'],
-                                       'api.get_student')['id']
-            self.student = Student.query.get_or_404(student_id)
-        except (KeyError, NotFound):
+            student = resolver.get(Student, 'api.get_student',
+                                   data['student_url'])
+        except KeyError:
+            student = None
+        if student is None:
             raise ValidationError('Invalid student URL')
         try:
-            class_id = args_from_url(data['class_url'], 'api.get_class')['id']
-            self.class_ = Class.query.get_or_404(class_id)
-        except (KeyError, NotFound):
+            class_ = resolver.get(Class, 'api.get_class', data['class_url'])
+        except KeyError:
+            class_ = None
+        if class_ is None:
             raise ValidationError('Invalid class URL')
+        # the relationships are assigned after both have been validated, so
+        # that an invalid registration is never added to the session
+        self.student = student
+        self.class_ = class_
         return self
 
+    @staticmethod
+    def preload(items, resolver):
+        """Load the students and classes referenced by a list of
+        registrations, using a single query for each model."""
+        items = [data for data in items if isinstance(data, dict)]
+        resolver.preload(Student, 'api.get_student',
+                         [data.get('student_url') for data in items])
+        resolver.preload(Class, 'api.get_class',
+                         [data.get('class_url') for data in items])
+
 
 class Student(db.Model):
     __tablename__ = 'students'
+    filterable = ['id', 'name']
+    sortable = ['id', 'name']
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     registrations = db.relationship(
         'Registration',
-        backref=db.backref('student', lazy='joined'),
+        backref='student',
         lazy='dynamic', cascade='all, delete-orphan')
 
     def get_url(self):
-        return url_for('api.get_student', id=self.id, _external=True)
+        return build_url('api.get_student', id=self.id)
 
-    def export_data(self):
+    def export_data(self, expand=()):
         return {'self_url': self.get_url(),
                 'name': self.name,
-                'registrations_url': url_for('api.get_student_registrations',
-                                             id=self.id, _external=True)}
+                'registrations_url': build_url(
+                    'api.get_student_registrations', id=self.id)}
 
     def import_data(self, data):
         try:
@@ -73,21 +148,25 @@ class Student(db.Model):
 
 class Class(db.Model):
     __tablename__ = 'classes'
+    filterable = ['id', 'name']
+    sortable = ['id', 'name']
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     registrations = db.relationship(
         'Registration',
-        backref=db.backref('class_', lazy='joined'),
+        backref='class_',
         lazy='dynamic', cascade='all, delete-orphan')
 
     def get_url(self):
-        return url_for('api.get_class', id=self.id, _external=True)
+        return build_url('api.get_class', id=self.id)
 
-    def export_data(self):
+    def export_data(self, expand=()):
         return {'self_url': self.get_url(),
                 'name': self.name,
-                'registrations_url': url_for('api.get_class_registrations',
-                                             id=self.id, _external=True)}
+                'registrations_url': build_url(
+                    'api.get_class_registrations', id=self.id)}
 
     def import_data(self, data):
         try:
@@ -102,6 +181,7 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True)
     password_hash = db.Column(db.String(128))
+    tier = db.Column(db.String(16), default='default')
 
     @property
     def password(self):
@@ -109,21 +189,24 @@ class User(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return check_password(self.password_hash, password)
 
     def generate_auth_token(self, expires_in=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expires_in=expires_in)
-        return s.dumps({'id': self.id}).decode('utf-8')
+        return get_token_signer().sign(self.id, expires_in)
+
+    @staticmethod
+    def load_auth_token(token):
+        """Return the id of the user that owns the token, or None if the
+        token is invalid or expired."""
+        return get_token_signer().verify(token)
 
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
+        id = User.load_auth_token(token)
+        if id is None:
             return None
-        return User.query.get(data['id'])
+        return User.query.get(id)
 
@@ -0,0 +1,54 @@
+from multiprocessing.pool import Pool, ThreadPool
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+def _get_pool():
+    """Return the pool that runs password hashing for the current
+    application, or None if hashing runs in the calling thread. The pool is
+    selected with the PASSWORD_HASH_POOL configuration variable, which can be
+    'thread', 'process', 'gevent' or None. The 'gevent' pool runs hashing in
+    native threads when the application is served by the cooperative
+    server, where the threads of the 'thread' pool are greenlets."""
+    pool_type = current_app.config['PASSWORD_HASH_POOL']
+    if pool_type is None:
+        return None
+    pool = current_app.extensions.get('password_hash_pool')
+    if pool is None:
+        workers = current_app.config['PASSWORD_HASH_WORKERS']
+        if pool_type == 'process':
+            pool = Pool(workers)
+        elif pool_type == 'gevent':
+            from gevent.threadpool import ThreadPool as NativeThreadPool
+            pool = NativeThreadPool(workers)
+        else:
+            pool = ThreadPool(workers)
+        current_app.extensions['password_hash_pool'] = pool
+    return pool
+
+
+def _run(f, *args):
+    pool = _get_pool()
+    if pool is None:
+        return f(*args)
+    # the calling thread waits for the result without holding the GIL, so
+    # other threads of the worker can continue serving requests
+    return pool.apply(f, args)
+
+
+def hash_password(password):
+    """Hash a password with the method given in the PASSWORD_HASH_METHOD
+    configuration variable."""
+    return _run(generate_password_hash, password,
+                current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def check_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """Return True if the password hash was not generated with the current
+    hashing method."""
+    return password_hash.split('$', 1)[0] != \
+        current_app.config['PASSWORD_HASH_METHOD']
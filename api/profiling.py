@@ -0,0 +1,184 @@
+"""Request profiling.
+
+When the USE_PROFILING configuration variable is set, the time spent in each
+stage of a request is recorded, together with the number and the duration of
+the SQL statements and Redis calls it issues. Stages can be nested, and the
+duration of a stage includes the stages nested in it. The timings are sent to
+the client in a ``Server-Timing`` header, and aggregated in histograms for
+each endpoint, which are returned by the ``/stats/requests`` endpoint."""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, request, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of the histogram buckets, in seconds for durations and in
+# statements for SQL statement counts
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+
+class Profile(object):
+    """Timings of the stages of a request, as [count, duration] pairs."""
+    def __init__(self):
+        self.start = time.time()
+        self.stages = {}
+        self.order = []
+
+    def add(self, stage, duration, count=1):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = [0, 0.0]
+            self.order.append(stage)
+        entry[0] += count
+        entry[1] += duration
+
+    def server_timing(self):
+        """Return the timings formatted as a Server-Timing header."""
+        metrics = []
+        for stage in self.order:
+            count, duration = self.stages[stage]
+            metric = '{0};dur={1:.3f}'.format(stage, duration * 1000)
+            if stage in ['sql', 'redis']:
+                metric += ';desc="{0} calls"'.format(count)
+            metrics.append(metric)
+        return ', '.join(metrics)
+
+
+class Histogram(object):
+    """Distribution of observed values over a fixed set of buckets."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """Return the number of values that are less than or equal to each
+        bucket bound, as (bound, count) pairs. The last bound is None, and
+        its count is the total."""
+        counts = []
+        total = 0
+        for bound, count in zip(self.buckets + [None], self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'buckets': [[bound, count] for bound, count
+                            in self.cumulative_counts()]}
+
+
+class RequestStats(object):
+    """Histograms of the stage durations and of the number of SQL
+    statements of the requests handled by the process, by endpoint."""
+    def __init__(self):
+        self.durations = {}
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, profile):
+        with self.lock:
+            durations = self.durations.setdefault(endpoint, {})
+            for stage, (count, duration) in profile.stages.items():
+                histogram = durations.get(stage)
+                if histogram is None:
+                    histogram = durations[stage] = \
+                        Histogram(DURATION_BUCKETS)
+                histogram.observe(duration)
+            histogram = self.queries.get(endpoint)
+            if histogram is None:
+                histogram = self.queries[endpoint] = Histogram(COUNT_BUCKETS)
+            histogram.observe(profile.stages.get('sql', [0])[0])
+
+    def to_dict(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, durations in self.durations.items():
+                endpoints[endpoint] = {
+                    'durations': dict((stage, histogram.to_dict())
+                                      for stage, histogram
+                                      in durations.items()),
+                    'queries': self.queries[endpoint].to_dict()}
+            return endpoints
+
+
+def get_request_stats():
+    """Return the request statistics of the current application."""
+    stats = current_app.extensions.get('request_stats')
+    if stats is None:
+        stats = current_app.extensions['request_stats'] = RequestStats()
+    return stats
+
+
+def get_profile():
+    """Return the profile of the current request, or None if the request is
+    not being profiled."""
+    if not has_request_context():
+        return None
+    return g.get('profile')
+
+
+@contextmanager
+def timed(stage):
+    """Record the time spent in a block of code as a stage of the profile of
+    the current request."""
+    profile = get_profile()
+    if profile is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile.add(stage, time.time() - start)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    # the start time is stored in the execution context, so that it is
+    # discarded with it when the statement fails
+    if context is not None and get_profile() is not None:
+        context._profile_start = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = getattr(context, '_profile_start', None)
+    profile = get_profile()
+    if start is not None and profile is not None:
+        profile.add('sql', time.time() - start)
+
+
+def start_profile():
+    if current_app.config['USE_PROFILING']:
+        g.profile = Profile()
+
+
+def finish_profile(response):
+    profile = g.get('profile')
+    if profile is not None:
+        profile.add('total', time.time() - profile.start)
+        if current_app.config['PROFILING_SERVER_TIMING']:
+            response.headers['Server-Timing'] = profile.server_timing()
+        get_request_stats().record(request.endpoint or '<unmatched>',
+                                   profile)
+    return response
+
+
+def init_app(app):
+    """Install the request handlers that profile the requests handled by
+    the application."""
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
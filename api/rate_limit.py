@@ -1,56 +1,310 @@
+import math
+import threading
 import time
-from redis import Redis
+from redis import Redis, BlockingConnectionPool, RedisError
 from flask import current_app
+from .profiling import timed
 
-redis = None
+# Generic cell rate algorithm (GCRA). For each key the theoretical arrival
+# time (TAT) of the next request is stored. Each request moves the TAT
+# forward by the emission interval (period / limit) times the cost of the
+# request, and it is allowed if the new TAT is not more than one period
+# ahead of the current time. This is equivalent to a token bucket that holds
+# "limit" tokens and is refilled continuously.
+GCRA_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local period = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval * cost
+if new_tat - period > now then
+    return {0, tostring(tat)}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX',
+           math.max(1, math.ceil((new_tat - now) * 1000)))
+return {1, tostring(new_tat)}
+'''
+
+
+def _gcra(tat, now, interval, period, cost):
+    """Python version of the GCRA script. Returns a tuple with a flag that
+    indicates if the request is allowed and the updated TAT."""
+    if tat is None or tat < now:
+        tat = now
+    new_tat = tat + interval * cost
+    if new_tat - period > now:
+        return False, tat
+    return True, new_tat
+
+
+def _gcra_script(redis, keys, args):
+    now, interval, period, cost = [float(arg) for arg in args]
+    tat = redis.get(keys[0])
+    allowed, tat = _gcra(float(tat) if tat is not None else None, now,
+                         interval, period, cost)
+    if allowed:
+        redis.set(keys[0], repr(tat),
+                  px=max(1, int(math.ceil((tat - now) * 1000))))
+    return [int(allowed), repr(tat)]
 
 
 class FakeRedis(object):
-    """Redis mock used for testing."""
+    """In-memory stand-in for a Redis server, used for testing. It supports
+    the commands used by the application, including key expiration. Scripts
+    run the Python implementation registered for them in the scripts
+    dictionary."""
+    scripts = {GCRA_SCRIPT: _gcra_script}
+
     def __init__(self):
         self.v = {}
-        self.last_key = None
+        self.expires = {}
+
+    def _get(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.delete(key)
+        return self.v.get(key)
+
+    def get(self, key):
+        return self._get(key)
+
+    def set(self, key, value, ex=None, px=None):
+        self.v[key] = str(value)
+        self.expires.pop(key, None)
+        if ex is not None:
+            self.expire(key, ex)
+        if px is not None:
+            self.pexpire(key, px)
+        return True
+
+    def incr(self, key, amount=1):
+        value = int(self._get(key) or 0) + amount
+        self.v[key] = str(value)
+        return value
+
+    def expire(self, key, seconds):
+        return self.pexpire(key, seconds * 1000)
+
+    def pexpire(self, key, time_ms):
+        return self.pexpireat(key, int(time.time() * 1000) + time_ms)
+
+    def expireat(self, key, when):
+        return self.pexpireat(key, when * 1000)
+
+    def pexpireat(self, key, when_ms):
+        if self._get(key) is None:
+            return False
+        self.expires[key] = when_ms / 1000.0
+        return True
+
+    def ttl(self, key):
+        if self._get(key) is None:
+            return None
+        if key not in self.expires:
+            return -1
+        return int(math.ceil(self.expires[key] - time.time()))
+
+    def delete(self, *keys):
+        count = 0
+        for key in keys:
+            if key in self.v:
+                del self.v[key]
+                count += 1
+            self.expires.pop(key, None)
+        return count
 
     def pipeline(self):
-        return self
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        f = self.scripts[script]
+        return lambda keys=[], args=[]: f(self, keys, args)
 
-    def incr(self, key):
-        if self.v.get(key, None) is None:
-            self.v[key] = 0
-        self.v[key] += 1
-        self.last_key = key
 
-    def expireat(self, key, time):
-        pass
+class FakePipeline(object):
+    """Pipeline for the FakeRedis class. Commands are queued and then issued
+    when execute() is called."""
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+        return queue
 
     def execute(self):
-        return [self.v[self.last_key]]
+        results = [f(*args, **kwargs) for f, args, kwargs in self.commands]
+        self.commands = []
+        return results
 
 
-class RateLimit(object):
-    expiration_window = 10
+class MemoryBackend(object):
+    """Rate limit backend that keeps the state of the limits in the memory
+    of the process. Only appropriate for deployments with a single
+    process."""
+    max_keys = 10000
 
-    def __init__(self, key_prefix, limit, period):
-        global redis
-        if redis is None and current_app.config['USE_RATE_LIMITS']:
-            if current_app.config['TESTING']:
+    def __init__(self):
+        self.tats = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, now, interval, period, cost):
+        with self.lock:
+            if len(self.tats) > self.max_keys:
+                # keys with a TAT in the past have a full quota, so they can
+                # be discarded
+                self.tats = dict((k, tat) for k, tat in self.tats.items()
+                                 if tat > now)
+            allowed, tat = _gcra(self.tats.get(key), now, interval, period,
+                                 cost)
+            if allowed:
+                self.tats[key] = tat
+            return allowed, tat
+
+
+class RedisBackend(object):
+    """Rate limit backend that keeps the state of the limits in Redis. Each
+    request is resolved with a single round trip that runs the GCRA script.
+    If Redis cannot be reached the limits are temporarily enforced in the
+    memory of the process."""
+    def __init__(self, redis):
+        self.redis = redis
+        self.script = None
+        self.fallback = MemoryBackend()
+
+    def update(self, key, now, interval, period, cost):
+        try:
+            with timed('redis'):
+                if self.script is None:
+                    # some versions of redis-py load the script in the
+                    # server when it is registered, so this can fail as well
+                    self.script = self.redis.register_script(GCRA_SCRIPT)
+                allowed, tat = self.script(
+                    keys=['rate_limit:' + key],
+                    args=['%.6f' % now, '%.6f' % interval, period, cost])
+        except RedisError:
+            return self.fallback.update(key, now, interval, period, cost)
+        return bool(allowed), float(tat)
+
+
+class ReservingBackend(object):
+    """Wraps a rate limit backend to reserve quota for each key in chunks,
+    which are then consumed locally. This reduces the round trips to the
+    backend for clients that send many requests. Reserved quota that is not
+    used is lost, so the limits can become stricter but are never
+    exceeded."""
+    max_keys = 10000
+
+    def __init__(self, backend, chunk_size):
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.reservations = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, now, interval, period, cost):
+        with self.lock:
+            reservation = self.reservations.get(key)
+            if reservation is not None and reservation['expires'] > now \
+                    and reservation['available'] >= cost:
+                reservation['available'] -= cost
+                return True, reservation['tat'] - \
+                    reservation['available'] * interval
+        chunk = max(cost, min(self.chunk_size, int(period / interval)))
+        allowed, tat = self.backend.update(key, now, interval, period, chunk)
+        if not allowed and chunk > cost:
+            # there is not enough quota left for a full chunk
+            chunk = cost
+            allowed, tat = self.backend.update(key, now, interval, period,
+                                               chunk)
+        if not allowed:
+            return False, tat
+        with self.lock:
+            if len(self.reservations) > self.max_keys:
+                # expired reservations cannot be used anymore
+                self.reservations = dict(
+                    (k, r) for k, r in self.reservations.items()
+                    if r['expires'] > now)
+            self.reservations[key] = {'available': chunk - cost, 'tat': tat,
+                                      'expires': now + period}
+        return True, tat - (chunk - cost) * interval
+
+
+def get_connection_pool(url, max_connections, timeout):
+    """Return a Redis connection pool for the given URL. When all the
+    connections are in use requests wait for one to be released, which is
+    needed when many requests are handled concurrently by the cooperative
+    server."""
+    if hasattr(BlockingConnectionPool, 'from_url'):
+        return BlockingConnectionPool.from_url(
+            url, max_connections=max_connections, timeout=timeout,
+            socket_timeout=timeout)
+    # older versions of redis only parse URLs in the client
+    pool = Redis.from_url(url).connection_pool
+    connection_kwargs = dict(pool.connection_kwargs)
+    connection_kwargs['socket_timeout'] = timeout
+    return BlockingConnectionPool(max_connections=max_connections,
+                                  timeout=timeout,
+                                  connection_class=pool.connection_class,
+                                  **connection_kwargs)
+
+
+def get_backend():
+    """Return the rate limit backend for the current application. The
+    backend is selected with the RATELIMIT_BACKEND configuration variable,
+    which can be 'redis' or 'memory'."""
+    backend = current_app.extensions.get('rate_limit_backend')
+    if backend is None:
+        config = current_app.config
+        if config['RATELIMIT_BACKEND'] == 'memory':
+            backend = MemoryBackend()
+        else:
+            if config['TESTING']:
                 redis = FakeRedis()
             else:
-                redis = Redis()
+                redis = Redis(connection_pool=get_connection_pool(
+                    config['RATELIMIT_REDIS_URL'],
+                    config['RATELIMIT_REDIS_MAX_CONNECTIONS'],
+                    config['RATELIMIT_REDIS_TIMEOUT']))
+            backend = RedisBackend(redis)
+        if config['RATELIMIT_RESERVE']:
+            backend = ReservingBackend(backend, config['RATELIMIT_RESERVE'])
+        current_app.extensions['rate_limit_backend'] = backend
+    return backend
 
-        self.reset = (int(time.time()) // period) * period + period
-        self.key = key_prefix + str(self.reset)
+
+def get_policy(endpoint, method, tier):
+    """Return the group, limit, period and cost that apply to a request.
+    The group is given by the first entry in RATELIMIT_GROUPS that matches
+    the endpoint and method, and the limit and period come from the tier of
+    the user in RATELIMIT_TIERS. Returns None if no group matches."""
+    config = current_app.config
+    for group, endpoints, methods, cost in config['RATELIMIT_GROUPS']:
+        if (endpoints is None or endpoint in endpoints) and \
+                (methods is None or method in methods):
+            break
+    else:
+        return None
+    default_limits = config['RATELIMIT_TIERS']['default']
+    limits = config['RATELIMIT_TIERS'].get(tier, default_limits)
+    limit, period = limits.get(group, default_limits[group])
+    return group, limit, period, cost
+
+
+class RateLimit(object):
+    def __init__(self, key, limit, period, cost=1):
+        now = time.time()
+        interval = float(period) / limit
+        self.allowed, tat = get_backend().update(key, now, interval, period,
+                                                 cost)
         self.limit = limit
         self.period = period
-        p = redis.pipeline()
-        p.incr(self.key)
-        p.expireat(self.key, self.reset + self.expiration_window)
-        self.current = p.execute()[0]
-
-    @property
-    def allowed(self):
-        return self.current <= self.limit
-
-    @property
-    def remaining(self):
-        return self.limit - self.current
\ No newline at end of file
+        # the quota is fully replenished when the TAT is reached. A small
+        # tolerance absorbs the rounding of the TAT when stored in Redis
+        self.remaining = int(math.floor((period - (tat - now)) / interval +
+                                        0.001))
+        self.reset = int(math.ceil(tat))
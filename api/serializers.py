@@ -0,0 +1,49 @@
+import json
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+from flask import current_app, request
+
+
+def _json_dumps(obj, indent=None):
+    if indent:
+        return json.dumps(obj, indent=indent, separators=(',', ': '))
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _ujson_dumps(obj, indent=None):
+    return ujson.dumps(obj, indent=indent or 0,
+                       escape_forward_slashes=False)
+
+
+serializers = {'json': _json_dumps}
+if ujson is not None:
+    serializers['ujson'] = _ujson_dumps
+
+
+def get_serializer():
+    """Return the function that encodes JSON responses. The serializer is
+    selected with the JSON_SERIALIZER configuration variable, which can be
+    'json', 'ujson' or 'auto'. The 'auto' setting uses ujson when it is
+    installed, and the json module from the standard library when it is
+    not."""
+    name = current_app.config['JSON_SERIALIZER']
+    if name == 'auto':
+        name = 'ujson' if 'ujson' in serializers else 'json'
+    return serializers[name]
+
+
+def pretty_print():
+    """Return True if the response to the current request should be
+    indented. Only clients that prefer HTML, such as web browsers, receive
+    indented responses, and only when the JSONIFY_PRETTYPRINT_REGULAR
+    configuration variable is set."""
+    return current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] and \
+        request.accept_mimetypes.best_match(
+            ['application/json', 'text/html']) == 'text/html'
+
+
+def dumps(obj):
+    """Encode an object as JSON for the response to the current request."""
+    return get_serializer()(obj, indent=2 if pretty_print() else None)
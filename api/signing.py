@@ -0,0 +1,70 @@
+import base64
+import hashlib
+import hmac
+import time
+from flask import current_app
+try:
+    from hmac import compare_digest
+except ImportError:  # pragma: no cover
+    from itsdangerous import constant_time_compare as compare_digest
+
+
+class TokenSigner(object):
+    """Generates and verifies compact authentication tokens, with the format
+    ``<key id>.<user id>.<expiration>.<signature>``. The signature is an
+    HMAC-SHA256 of the rest of the token, so verifying a token does not need
+    any deserialization. Tokens are signed with the first key, and can be
+    verified with any of the keys, so that keys can be rotated without
+    invalidating the tokens that are in use."""
+    def __init__(self, keys):
+        self.macs = {}
+        self.signing_key_id = None
+        for key in keys:
+            if not isinstance(key, bytes):
+                key = key.encode('utf-8')
+            key_id = hashlib.sha256(key).hexdigest()[:8]
+            # the keyed HMAC objects are created once and copied for each
+            # signature, which saves the key setup
+            self.macs[key_id] = hmac.new(key, digestmod=hashlib.sha256)
+            if self.signing_key_id is None:
+                self.signing_key_id = key_id
+
+    def _signature(self, key_id, payload):
+        mac = self.macs[key_id].copy()
+        mac.update(payload)
+        return base64.urlsafe_b64encode(mac.digest()).rstrip(b'=')
+
+    def sign(self, user_id, expires_in):
+        payload = '{0}.{1}.{2}'.format(self.signing_key_id, user_id,
+                                       int(time.time()) + expires_in)
+        payload = payload.encode('ascii')
+        return (payload + b'.' + self._signature(self.signing_key_id,
+                                                 payload)).decode('ascii')
+
+    def verify(self, token):
+        """Return the id of the user that owns the token, or None if the
+        token is invalid or expired."""
+        try:
+            payload, signature = token.encode('ascii').rsplit(b'.', 1)
+            key_id, user_id, expires = payload.decode('ascii').split('.')
+            user_id = int(user_id)
+            expires = int(expires)
+        except (AttributeError, ValueError):
+            return None
+        if key_id not in self.macs or \
+                not compare_digest(signature,
+                                   self._signature(key_id, payload)):
+            return None
+        if expires < time.time():
+            return None
+        return user_id
+
+
+def get_token_signer():
+    """Return the token signer for the current application, created from
+    the keys in the TOKEN_SECRET_KEYS configuration variable."""
+    signer = current_app.extensions.get('token_signer')
+    if signer is None:
+        signer = TokenSigner(current_app.config['TOKEN_SECRET_KEYS'])
+        current_app.extensions['token_signer'] = signer
+    return signer
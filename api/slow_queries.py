@@ -0,0 +1,110 @@
+"""Slow query log.
+
+SQL statements that take longer than the SLOW_QUERY_THRESHOLD configuration
+variable are written to the file given in SLOW_QUERY_LOG, one JSON object
+per line. Each entry includes the endpoint and the collection arguments of
+the request that issued the statement, and the plan of the statement as
+reported by the database. Only a SLOW_QUERY_SAMPLE_RATE fraction of the slow
+statements is logged, and the log is rotated when it grows above
+SLOW_QUERY_LOG_MAX_BYTES, keeping SLOW_QUERY_LOG_BACKUPS old logs.
+
+Rotation is only safe when a single process writes to the log. When
+SLOW_QUERY_LOG_MAX_BYTES is 0 the log is never rotated by the application,
+and it is reopened when it is moved by an external tool such as logrotate,
+which is what deployments with several processes need."""
+import json
+import logging
+import random
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler, WatchedFileHandler
+from flask import request, g, has_request_context
+from sqlalchemy import event
+
+EXPLAIN = {'sqlite': 'EXPLAIN QUERY PLAN ', 'postgresql': 'EXPLAIN ',
+           'mysql': 'EXPLAIN '}
+
+
+def get_logger(config):
+    """Return a logger that writes to the slow query log given in the
+    configuration."""
+    # the logger is not registered with the logging module, so each engine
+    # writes to the file given in its own configuration
+    logger = logging.Logger('api.slow_queries')
+    if config['SLOW_QUERY_LOG_MAX_BYTES']:
+        handler = RotatingFileHandler(
+            config['SLOW_QUERY_LOG'],
+            maxBytes=config['SLOW_QUERY_LOG_MAX_BYTES'],
+            backupCount=config['SLOW_QUERY_LOG_BACKUPS'])
+    else:
+        handler = WatchedFileHandler(config['SLOW_QUERY_LOG'])
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    return logger
+
+
+def explain(dbapi_connection, dialect, statement, parameters):
+    """Return the plan of a statement as a list of rows, or None if the
+    database cannot explain it. The plan is obtained with a separate cursor,
+    so the results of the statement are not affected. On PostgreSQL an
+    error aborts the transaction, so the plan is obtained in a savepoint
+    that is rolled back if it fails."""
+    prefix = EXPLAIN.get(dialect.name)
+    if prefix is None or not statement.lstrip().upper().startswith('SELECT'):
+        return None
+    savepoint = dialect.name == 'postgresql' and \
+        not getattr(dbapi_connection, 'autocommit', False)
+    cursor = dbapi_connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            plan = [[str(column) for column in row]
+                    for row in cursor.fetchall()]
+        except Exception as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return ['plan not available: {0}'.format(e)]
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        return plan
+    finally:
+        cursor.close()
+
+
+def configure_slow_query_log(engine, config):
+    """Install the event handlers that write the slow statements issued by
+    an engine to the slow query log."""
+    logger = get_logger(config)
+    threshold = config['SLOW_QUERY_THRESHOLD']
+    sample_rate = config['SLOW_QUERY_SAMPLE_RATE']
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        if context is not None:
+            context.slow_query_start = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        start = getattr(context, 'slow_query_start', None)
+        if start is None:
+            return
+        duration = time.time() - start
+        if duration < threshold or random.random() >= sample_rate:
+            return
+        entry = {'time': datetime.utcnow().isoformat() + 'Z',
+                 'duration': round(duration, 6),
+                 'statement': statement}
+        if has_request_context():
+            entry.update({'endpoint': request.endpoint,
+                          'method': request.method,
+                          'collection': g.get('collection_args')})
+        if config['SLOW_QUERY_LOG_PARAMETERS']:
+            entry['parameters'] = repr(parameters)
+        if not executemany:
+            entry['plan'] = explain(conn.connection, conn.dialect, statement,
+                                    parameters)
+        logger.warning(json.dumps(entry, sort_keys=True))
@@ -0,0 +1,33 @@
+from flask import Blueprint, current_app
+from .auth import auth
+from .database import pool_stats
+from .decorators import json
+from .models import db
+from . import metrics, profiling
+
+stats = Blueprint('stats', __name__)
+
+
+@stats.before_request
+@auth.login_required
+def before_request():
+    pass
+
+
+@stats.route('/database', methods=['GET'])
+@json
+def get_database_stats():
+    return {'pool': pool_stats(db.engine)}
+
+
+@stats.route('/requests', methods=['GET'])
+@json
+def get_request_stats():
+    return {'endpoints': profiling.get_request_stats().to_dict()}
+
+
+@stats.route('/metrics', methods=['GET'])
+def get_metrics():
+    return current_app.response_class(
+        metrics.generate_metrics(db.engine),
+        mimetype='text/plain; version=0.0.4')
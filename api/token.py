@@ -1,6 +1,6 @@
 from flask import Blueprint, jsonify, g
 from flask_httpauth import HTTPBasicAuth
-from .models import User
+from .auth import verify_credentials
 from .errors import unauthorized
 from .decorators import json
 
@@ -10,10 +10,8 @@ token_auth = HTTPBasicAuth()
 
 @token_auth.verify_password
 def verify_password(username, password):
-    g.user = User.query.filter_by(username=username).first()
-    if not g.user:
-        return False
-    return g.user.verify_password(password)
+    g.user = verify_credentials(username, password)
+    return g.user is not None
 
 
 @token_auth.error_handler
@@ -26,7 +26,7 @@ def bad_request_error(e):
 
 @api.before_request
 @auth.login_required
-@rate_limit(limit=5, period=15)
+@rate_limit
 def before_request():
     pass
 
@@ -1,10 +1,12 @@
 from flask import request
 from ..models import db, Class, Registration
-from ..decorators import json, collection, etag
+from ..bulk import get_bulk_items, bulk_import
+from ..decorators import json, collection, etag, cached, versioned
 from . import api
 
 
 @api.route('/classes/', methods=['GET'])
+@cached(Class)
 @etag
 @json
 @collection(Class)
@@ -13,13 +15,16 @@ def get_classes():
 
 
 @api.route('/classes/<int:id>', methods=['GET'])
+@cached(Class)
 @etag
+@versioned(Class)
 @json
 def get_class(id):
     return Class.query.get_or_404(id)
 
 
 @api.route('/classes/<int:id>/registrations/', methods=['GET'])
+@cached(Registration, Class)
 @etag
 @json
 @collection(Registration)
@@ -37,6 +42,14 @@ def new_class():
     return {}, 201, {'Location': class_.get_url()}
 
 
+@api.route('/classes/bulk', methods=['POST'])
+@json
+def new_classes():
+    items = bulk_import(get_bulk_items(),
+                        lambda data: Class().import_data(data))
+    return {'items': items}
+
+
 @api.route('/classes/<int:id>/registrations/', methods=['POST'])
 @json
 def new_class_registration(id):
@@ -1,10 +1,12 @@
 from flask import request
-from ..models import db, Registration
-from ..decorators import json, collection, etag
+from ..models import db, Registration, Resolver
+from ..bulk import get_bulk_items, bulk_import
+from ..decorators import json, collection, etag, cached, versioned
 from . import api
 
 
 @api.route('/registrations/', methods=['GET'])
+@cached(Registration)
 @etag
 @json
 @collection(Registration)
@@ -13,7 +15,9 @@ def get_registrations():
 
 
 @api.route('/registrations/<int:student_id>/<int:class_id>', methods=['GET'])
+@cached(Registration)
 @etag
+@versioned(Registration)
 @json
 def get_registration(student_id, class_id):
     return Registration.query.get_or_404((student_id, class_id))
@@ -28,6 +32,17 @@ def new_registration():
     return {}, 201, {'Location': reg.get_url()}
 
 
+@api.route('/registrations/bulk', methods=['POST'])
+@json
+def new_registrations():
+    resolver = Resolver()
+    items = bulk_import(
+        get_bulk_items(),
+        lambda data: Registration().import_data(data, resolver),
+        lambda chunk: Registration.preload(chunk, resolver))
+    return {'items': items}
+
+
 @api.route('/registrations/<int:student_id>/<int:class_id>', methods=['DELETE'])
 @json
 def delete_registration(student_id, class_id):
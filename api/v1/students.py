@@ -1,10 +1,12 @@
 from flask import request
 from ..models import db, Student, Registration
-from ..decorators import json, collection, etag
+from ..bulk import get_bulk_items, bulk_import
+from ..decorators import json, collection, etag, cached, versioned
 from . import api
 
 
 @api.route('/students/', methods=['GET'])
+@cached(Student)
 @etag
 @json
 @collection(Student)
@@ -13,13 +15,16 @@ def get_students():
 
 
 @api.route('/students/<int:id>', methods=['GET'])
+@cached(Student)
 @etag
+@versioned(Student)
 @json
 def get_student(id):
     return Student.query.get_or_404(id)
 
 
 @api.route('/students/<int:id>/registrations/', methods=['GET'])
+@cached(Registration, Student)
 @etag
 @json
 @collection(Registration)
@@ -37,6 +42,14 @@ def new_student():
     return {}, 201, {'Location': student.get_url()}
 
 
+@api.route('/students/bulk', methods=['POST'])
+@json
+def new_students():
+    items = bulk_import(get_bulk_items(),
+                        lambda data: Student().import_data(data))
+    return {'items': items}
+
+
 @api.route('/students/<int:id>/registrations/', methods=['POST'])
 @json
 def new_student_registration(id):
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Benchmark of concurrent polling clients.
+
+Starts the API with the threaded WSGI server from Werkzeug and with the
+cooperative server in api/async_server.py, and runs the given numbers of
+concurrent clients against each of them. Each client requests the students
+collection once per second, on a new connection. The number of completed
+polls, the latency of the polls and the number of failed polls are
+reported. The servers use a temporary SQLite database.
+
+Requires gevent.
+
+Usage: python -m benchmarks.concurrency [clients ...] [--duration seconds]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from base64 import b64encode
+
+PORT = 5055
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+
+def config(database):
+    import config as base_config
+    values = dict((key, getattr(base_config, key))
+                  for key in dir(base_config) if key.isupper())
+    values.update({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database,
+                   'USE_RATE_LIMITS': False,
+                   'USE_TOKEN_AUTH': False,
+                   'PASSWORD_HASH_POOL': None})
+    return type('BenchmarkConfig', (object,), values)
+
+
+def setup(database):
+    from api.app import create_app
+    from api.models import db, User, Student
+    from api import migrations
+    app = create_app(config(database))
+    with app.app_context():
+        migrations.upgrade(db.engine)
+        db.session.add(User(username=USERNAME, password=PASSWORD))
+        db.session.add_all([Student(name='student' + str(i))
+                            for i in range(100)])
+        db.session.commit()
+
+
+def serve(mode, database):
+    if mode == 'gevent':
+        from api.async_server import make_server
+        from api.app import create_app
+        make_server(create_app(config(database)), port=PORT,
+                    log=None).serve_forever()
+    else:
+        from werkzeug.serving import run_simple
+        from api.app import create_app
+        run_simple('127.0.0.1', PORT, create_app(config(database)),
+                   threaded=True)
+
+
+def poll_clients(clients, duration, interval=1.0):
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    try:
+        from http.client import HTTPConnection
+    except ImportError:  # pragma: no cover
+        from httplib import HTTPConnection
+    auth = 'Basic ' + b64encode((USERNAME + ':' + PASSWORD).encode(
+        'utf-8')).decode('utf-8')
+    latencies = []
+    errors = [0]
+    end = time.time() + duration
+
+    def client():
+        while time.time() < end:
+            start = time.time()
+            try:
+                conn = HTTPConnection('127.0.0.1', PORT, timeout=30)
+                conn.request('GET', '/v1/students/',
+                             headers={'Authorization': auth})
+                rv = conn.getresponse()
+                rv.read()
+                conn.close()
+                if rv.status != 200:
+                    raise ValueError(rv.status)
+                latencies.append(time.time() - start)
+            except Exception:
+                errors[0] += 1
+            gevent.sleep(max(0, interval - (time.time() - start)))
+
+    gevent.joinall([gevent.spawn(client) for i in range(clients)])
+    latencies.sort()
+    return len(latencies), latencies, errors[0]
+
+
+def wait_for_server(timeout=10):
+    import socket
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', PORT), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('the server did not start')
+
+
+def run(clients=(10, 100, 1000), duration=10):
+    tmpdir = tempfile.mkdtemp()
+    database = os.path.join(tmpdir, 'benchmark.sqlite')
+    setup(database)
+    results = []
+    try:
+        for mode in ['wsgi', 'gevent']:
+            for n in clients:
+                server = subprocess.Popen(
+                    [sys.executable, '-m', 'benchmarks.concurrency',
+                     '--serve', mode, database],
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                try:
+                    wait_for_server()
+                    client = subprocess.Popen(
+                        [sys.executable, '-m', 'benchmarks.concurrency',
+                         '--clients', str(n), str(duration)],
+                        stdout=subprocess.PIPE)
+                    output = client.communicate()[0].decode('utf-8')
+                    completed, p50, p99, errors = output.split()
+                    results.append((mode, n, int(completed) / duration,
+                                    float(p50), float(p99), int(errors)))
+                finally:
+                    server.terminate()
+                    server.wait()
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2], sys.argv[3])
+    elif sys.argv[1:2] == ['--clients']:
+        completed, latencies, errors = poll_clients(int(sys.argv[2]),
+                                                    float(sys.argv[3]))
+        percentile = lambda p: latencies[int(len(latencies) * p)] \
+            if latencies else 0
+        print(completed, percentile(0.5), percentile(0.99), errors)
+    else:
+        args = sys.argv[1:]
+        duration = 10
+        if '--duration' in args:
+            i = args.index('--duration')
+            duration = int(args[i + 1])
+            del args[i:i + 2]
+        clients = [int(arg) for arg in args] or [10, 100, 1000]
+        print('{0:<8} {1:>8} {2:>10} {3:>10} {4:>10} {5:>8}'.format(
+            'server', 'clients', 'polls/s', 'p50 (ms)', 'p99 (ms)',
+            'errors'))
+        for mode, n, rate, p50, p99, errors in run(clients, duration):
+            print('{0:<8} {1:>8} {2:>10.1f} {3:>10.1f} {4:>10.1f} '
+                  '{5:>8}'.format(mode, n, rate, p50 * 1000, p99 * 1000,
+                                  errors))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Micro-benchmark of the cost of recording metrics.
+
+Measures the time taken to increment a counter and to record a value in a
+histogram, and the time taken to handle a request for a cached resource
+with and without metrics. A request records several metrics.
+
+Usage: python -m benchmarks.metrics [iterations]
+"""
+import sys
+import timeit
+from api.app import create_app
+from api.models import db, User
+from api.metrics import REQUESTS, REQUEST_DURATION
+from tests.test_client import TestClient
+
+
+def run(iterations=10000):
+    app = create_app('test_config')
+    results = []
+    with app.test_request_context('/v1/students/'):
+        for name, f in [
+                ('counter', lambda: REQUESTS.inc('api.get_students', 'GET',
+                                                 200)),
+                ('histogram', lambda: REQUEST_DURATION.observe(
+                    0.0042, 'api.get_students'))]:
+            elapsed = min(timeit.repeat(f, number=iterations, repeat=3))
+            results.append((name, elapsed / iterations))
+
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', password='bench')
+        db.session.add(user)
+        db.session.commit()
+        client = TestClient(app, user.generate_auth_token(), '')
+        for use_metrics in [False, True]:
+            app.config['USE_METRICS'] = use_metrics
+            elapsed = min(timeit.repeat(lambda: client.get('/v1/students/'),
+                                        number=iterations // 10, repeat=3))
+            results.append(('request' + (' with metrics' if use_metrics
+                                         else ''),
+                            elapsed / (iterations // 10)))
+    return results
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, elapsed in run(iterations):
+        print('{0:<22} {1:>10.3f} us'.format(name, elapsed * 1000000))
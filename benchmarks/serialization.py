@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Benchmark of the serialization of a large expanded collection.
+
+Encodes a page of expanded registrations with Flask's jsonify(), which was
+used by the @json decorator before, and with each of the serializers
+available in api.serializers, and reports the time and size of each
+response.
+
+Usage: python -m benchmarks.serialization [rows]
+"""
+import sys
+import timeit
+from datetime import datetime
+from flask import jsonify
+from api.app import create_app
+from api.models import Registration
+from api.serializers import serializers
+
+
+def run(rows=10000, repeat=3):
+    app = create_app('test_config')
+    with app.test_request_context('/'):
+        items = [Registration(student_id=i, class_id=i % 100,
+                              timestamp=datetime.utcnow()).export_data()
+                 for i in range(rows)]
+        data = {'registrations': items,
+                'meta': {'page': 1, 'per_page': rows, 'total': rows}}
+
+        encoders = [('jsonify', lambda: jsonify(data).get_data())]
+        for name in sorted(serializers):
+            encoders.append((name, lambda f=serializers[name]: f(data)))
+            encoders.append((name + ' (indented)',
+                             lambda f=serializers[name]: f(data, indent=2)))
+
+        results = []
+        for name, f in encoders:
+            size = len(f())
+            elapsed = min(timeit.repeat(f, number=1, repeat=repeat))
+            results.append((name, elapsed, size))
+    return results
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, elapsed, size in run(rows):
+        print('{0:<20} {1:>8.1f} ms/response  {2:>9} bytes/response'.format(
+            name, elapsed * 1000, size))
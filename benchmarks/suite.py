@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""Benchmark suite of representative API requests.
+
+Seeds a temporary SQLite database with students, classes and registrations,
+and sends a fixed number of requests of each scenario through the test
+client of the application. The throughput and the median and 99th
+percentile latencies of each scenario are reported. Rate limits and the
+response cache are disabled, so that every request runs the decorators and
+models being measured.
+
+Pass --save to store the results as the baseline, and --compare to compare
+them against the stored baseline. When comparing, the exit status is 1 if
+the throughput of a scenario dropped, or its median latency grew, by more
+than the tolerance. Baselines are only comparable on the same machine.
+
+Usage: python -m benchmarks.suite [--students N] [--requests N]
+                                  [--scenario NAME ...] [--save | --compare]
+                                  [--baseline FILE] [--tolerance FRACTION]
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+from optparse import OptionParser
+from timeit import default_timer
+from api.app import create_app
+from api.models import db, User, Student, Class, Registration
+from api import migrations
+from tests.test_client import TestClient
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def config(database):
+    import config as base_config
+    values = dict((key, getattr(base_config, key))
+                  for key in dir(base_config) if key.isupper())
+    values.update({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database,
+                   'USE_RATE_LIMITS': False,
+                   'USE_RESPONSE_CACHE': False,
+                   'CACHE_TYPE': 'lru'})
+    return type('BenchmarkConfig', (object,), values)
+
+
+def seed(students, classes, registrations_per_student):
+    """Insert the given number of students and classes, and register each
+    student in random classes. The random generator is seeded, so the data
+    is the same in every run."""
+    rand = random.Random(42)
+    db.session.add(User(username=USERNAME, password=PASSWORD))
+    db.session.commit()
+    db.engine.execute(Student.__table__.insert(), [
+        {'name': 'student{0}'.format(i)} for i in range(students)])
+    db.engine.execute(Class.__table__.insert(), [
+        {'name': 'class{0}'.format(i)} for i in range(classes)])
+    now = datetime.utcnow()
+    registrations = []
+    for student_id in range(1, students + 1):
+        for class_id in rand.sample(range(1, classes + 1),
+                                    registrations_per_student):
+            registrations.append({'student_id': student_id,
+                                  'class_id': class_id, 'timestamp': now,
+                                  'updated_at': now})
+    db.engine.execute(Registration.__table__.insert(), registrations)
+
+
+def scenarios(students, classes, password_client):
+    """Return the scenarios as (name, setup, request) tuples. Requests are
+    functions that send a request with a client given the iteration
+    number, and return the response. The setup function, if given, is
+    called with the client before the scenario is timed. Tokens are
+    requested with the password client."""
+    # the pages requested from the students and registrations collections,
+    # which must exist with the smaller data sets used in tests
+    student_pages = min(20, max(1, students // 25))
+    registration_pages = min(20, max(1, students // 50))
+
+    def list_students(client, i):
+        return client.get('/v1/students/?page={0}&per_page=25'.format(
+            i % student_pages + 1))
+
+    def list_students_expanded(client, i):
+        return client.get('/v1/students/?filter=name,like,student{0}%25'
+                          '&sort=name,desc&expand=1&per_page=25'.format(
+                              i % 10))
+
+    def list_registrations_expanded(client, i):
+        return client.get('/v1/classes/{0}/registrations/?expand=1'
+                          '&sort=timestamp,desc&per_page=50'.format(
+                              i % classes + 1))
+
+    def list_registrations_nested(client, i):
+        return client.get('/v1/registrations/?expand=student,class'
+                          '&per_page=50&page={0}'.format(
+                              i % registration_pages + 1))
+
+    def list_registrations_cursor(client, i):
+        return client.get('/v1/registrations/?cursor=&per_page=50'
+                          '&filter=class_id,eq,{0}'.format(i % classes + 1))
+
+    def get_student(client, i):
+        return client.get('/v1/students/{0}'.format(i % students + 1))
+
+    etags = {}
+
+    def get_etags(client):
+        for i in range(min(100, students)):
+            url = '/v1/students/{0}'.format(i + 1)
+            etags[url] = client.get(url)[0].headers['ETag']
+
+    def get_student_not_modified(client, i):
+        url = '/v1/students/{0}'.format(i % len(etags) + 1)
+        return client.get(url, headers={'If-None-Match': etags[url]})
+
+    def request_token(client, i):
+        return password_client.post('/auth/request-token', data={})
+
+    def bulk_create(client, i):
+        return client.post('/v1/students/bulk', data=[
+            {'name': 'bulk{0}-{1}'.format(i, j)} for j in range(100)])
+
+    return [('list_students', None, list_students),
+            ('list_students_expanded', None, list_students_expanded),
+            ('list_registrations_expanded', None,
+             list_registrations_expanded),
+            ('list_registrations_nested', None, list_registrations_nested),
+            ('list_registrations_cursor', None, list_registrations_cursor),
+            ('get_student', None, get_student),
+            ('get_student_not_modified', get_etags,
+             get_student_not_modified),
+            ('request_token', None, request_token),
+            ('bulk_create', None, bulk_create)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(students=1000, classes=100, registrations_per_student=5,
+        requests=200, only=None):
+    """Run the scenarios and return their results, as a dictionary with the
+    throughput in requests per second and the p50 and p99 latencies in
+    seconds of each scenario."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        app = create_app(config(os.path.join(tmpdir, 'benchmark.sqlite')))
+        with app.app_context():
+            migrations.upgrade(db.engine)
+            seed(students, classes, registrations_per_student)
+            user = User.query.filter_by(username=USERNAME).first()
+            client = TestClient(app, user.generate_auth_token(), '')
+            password_client = TestClient(app, USERNAME, PASSWORD)
+
+            results = {}
+            for name, setup, f in scenarios(students, classes,
+                                            password_client):
+                if only and name not in only:
+                    continue
+                if setup is not None:
+                    setup(client)
+                # the first requests warm up the caches
+                for i in range(min(10, requests)):
+                    f(client, i)
+                latencies = []
+                for i in range(requests):
+                    start = default_timer()
+                    rv, data = f(client, i)
+                    latencies.append(default_timer() - start)
+                    assert rv.status_code < 400, (name, rv.status_code,
+                                                  data)
+                    db.session.remove()
+                results[name] = {
+                    'throughput': len(latencies) / sum(latencies),
+                    'p50': percentile(latencies, 0.5),
+                    'p99': percentile(latencies, 0.99)}
+            return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def compare(results, baseline, tolerance):
+    """Compare results against a baseline. Returns a list of (scenario,
+    message) tuples with the regressions found."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append((name, 'throughput {0:.1f}/s, baseline '
+                                '{1:.1f}/s'.format(result['throughput'],
+                                                   base['throughput'])))
+        if result['p50'] > base['p50'] * (1 + tolerance):
+            regressions.append((name, 'p50 {0:.2f} ms, baseline '
+                                '{1:.2f} ms'.format(result['p50'] * 1000,
+                                                    base['p50'] * 1000)))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = OptionParser(description='Benchmark representative API '
+                          'requests.')
+    parser.add_option('--students', type='int', default=1000)
+    parser.add_option('--classes', type='int', default=100)
+    parser.add_option('--registrations', type='int', default=5,
+                      help='registrations per student')
+    parser.add_option('--requests', type='int', default=200,
+                      help='requests per scenario')
+    parser.add_option('--scenario', action='append',
+                      help='run only the given scenarios')
+    parser.add_option('--baseline', default=DEFAULT_BASELINE)
+    parser.add_option('--tolerance', type='float', default=0.2)
+    parser.add_option('--save', action='store_true',
+                      help='store the results as the baseline')
+    parser.add_option('--compare', action='store_true',
+                      help='compare the results against the baseline')
+    args = parser.parse_args()[0]
+    if args.save and args.compare:
+        parser.error('--save and --compare cannot be used together')
+
+    results = run(args.students, args.classes, args.registrations,
+                  args.requests, args.scenario)
+    print('{0:<30} {1:>10} {2:>10} {3:>10}'.format(
+        'scenario', 'req/s', 'p50 (ms)', 'p99 (ms)'))
+    for name, result in sorted(results.items()):
+        print('{0:<30} {1:>10.1f} {2:>10.2f} {3:>10.2f}'.format(
+            name, result['throughput'], result['p50'] * 1000,
+            result['p99'] * 1000))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    elif args.compare:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, message in regressions:
+            print('REGRESSION {0}: {1}'.format(name, message))
+        sys.exit(1 if regressions else 0)
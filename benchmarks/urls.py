@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Benchmark of the per item cost of exporting a collection.
+
+Exports a page of registrations building the URLs of each item with
+url_for(), as export_data() did before, and with the cached URL templates of
+build_url(). The number of items given as argument is the page size. Pass
+--profile to print the functions where the time is spent in each case.
+
+Usage: python -m benchmarks.urls [items] [--profile]
+"""
+import cProfile
+import pstats
+import sys
+import timeit
+from datetime import datetime
+from flask import url_for
+from api.app import create_app
+from api.models import Registration
+
+
+def url_for_export_data(reg):
+    return {'self_url': url_for('api.get_registration',
+                                student_id=reg.student_id,
+                                class_id=reg.class_id, _external=True),
+            'student_url': url_for('api.get_student', id=reg.student_id,
+                                   _external=True),
+            'class_url': url_for('api.get_class', id=reg.class_id,
+                                 _external=True),
+            'timestamp': reg.timestamp.isoformat() + 'Z'}
+
+
+def run(items=1000, repeat=5, profile=False):
+    app = create_app('test_config')
+    regs = [Registration(student_id=i, class_id=i % 100,
+                         timestamp=datetime.utcnow()) for i in range(items)]
+    results = []
+    with app.test_request_context('/v1/registrations/?expand=1'):
+        for name, f in [('url_for', url_for_export_data),
+                        ('build_url', Registration.export_data)]:
+            def export():
+                return [f(reg) for reg in regs]
+            assert export() == [url_for_export_data(reg) for reg in regs]
+            elapsed = min(timeit.repeat(export, number=1, repeat=repeat))
+            results.append((name, elapsed / items))
+            if profile:
+                print('--- ' + name)
+                profiler = cProfile.Profile()
+                profiler.runcall(export)
+                pstats.Stats(profiler).sort_stats('cumulative') \
+                    .print_stats(12)
+    return results
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--profile']
+    items = int(args[0]) if args else 1000
+    for name, per_item in run(items, profile='--profile' in sys.argv):
+        print('{0:<12} {1:>8.2f} us/item'.format(name, per_item * 1e6))
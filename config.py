@@ -5,12 +5,163 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 
 SECRET_KEY = 'secret'
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'api.sqlite')
+
+# connection pool, used with client/server databases. SQLite databases open
+# a connection for each request
+SQLALCHEMY_POOL_SIZE = 10
+SQLALCHEMY_MAX_OVERFLOW = 10
+SQLALCHEMY_POOL_TIMEOUT = 10
+SQLALCHEMY_POOL_RECYCLE = 3600
+
+# read replicas, given as names of databases in SQLALCHEMY_BINDS. Queries
+# issued while handling GET and HEAD requests are sent to a random replica,
+# except for DATABASE_REPLICA_LAG seconds after a user writes, when the
+# requests of that user go to the primary. The lag must be longer than the
+# replication lag
+SQLALCHEMY_BINDS = {}
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_LAG = 5
+
+# test pooled connections before they are used, to replace connections that
+# were closed by the database server
+DATABASE_POOL_PRE_PING = True
+
+# maximum duration of a database statement, in seconds (None to disable)
+DATABASE_STATEMENT_TIMEOUT = 30
+
+# log statements that take longer than SLOW_QUERY_THRESHOLD seconds to the
+# SLOW_QUERY_LOG file (None to disable), with the request that issued them
+# and their query plan. Only a SLOW_QUERY_SAMPLE_RATE fraction of the slow
+# statements is logged. The log is rotated when it reaches
+# SLOW_QUERY_LOG_MAX_BYTES, which is only safe with a single process. When
+# several processes write to the log set SLOW_QUERY_LOG_MAX_BYTES to 0 and
+# rotate it with logrotate, which the application detects. Parameters are
+# not logged unless SLOW_QUERY_LOG_PARAMETERS is set, as they can contain
+# personal data
+SLOW_QUERY_LOG = None
+SLOW_QUERY_THRESHOLD = 0.5
+SLOW_QUERY_SAMPLE_RATE = 1.0
+SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+SLOW_QUERY_LOG_PARAMETERS = False
+
+# SQLite journal mode and synchronous settings, applied to each connection.
+# With write-ahead logging readers do not block writers, and the NORMAL
+# synchronous level is safe in this mode
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+
+# record the time spent in each stage of a request, and the SQL statements
+# and Redis calls it makes. The timings are aggregated by endpoint, and sent
+# to clients in a Server-Timing header unless PROFILING_SERVER_TIMING is
+# False
+USE_PROFILING = False
+PROFILING_SERVER_TIMING = True
+
+# record request, rate limit and cache metrics, which are returned in the
+# Prometheus text format by the /stats/metrics endpoint
+USE_METRICS = True
+
+# maximum number of connections handled concurrently by the cooperative
+# server in api/async_server.py
+ASYNC_MAX_CONNECTIONS = 10000
+
+# encoder for JSON responses: 'json', 'ujson' or 'auto' to use ujson when it
+# is installed. Responses are indented only for clients that prefer HTML
+JSON_SERIALIZER = 'auto'
+
+# clients authenticate with tokens requested from /auth/request-token, or
+# with their username and password in every request when False
 USE_TOKEN_AUTH = True
 
-# enable rate limits only if redis is running
+# keys used to sign authentication tokens. New tokens are signed with the
+# first key, and tokens signed with any of the keys are accepted, so to
+# rotate keys insert the new key at the start and remove the old one once
+# its tokens have expired
+TOKEN_SECRET_KEYS = [SECRET_KEY]
+
+# password hashing method, passwords hashed with a different method are
+# upgraded when the user logs in. Hashing can run in a 'thread' or 'process'
+# pool instead of in the thread that handles the request. Use 'gevent' with
+# the cooperative server in api/async_server.py
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:50000'
+PASSWORD_HASH_POOL = None
+PASSWORD_HASH_WORKERS = 2
+CREDENTIALS_CACHE_TIMEOUT = 60
+
+# server-side cache, can be 'lru' (in-process) or 'redis'. Changes only
+# invalidate the in-process cache of the process that made them, so with
+# 'lru' the cached responses and users expire after LOCAL_CACHE_TIMEOUT
+# seconds, use 'redis' when the application runs in several processes
+CACHE_TYPE = 'lru'
+CACHE_MAX_ITEMS = 10000
+CACHE_REDIS_URL = 'redis://localhost:6379/0'
+CACHE_TIMEOUT = 300
+LOCAL_CACHE_TIMEOUT = 5
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_TIMEOUT = 300
+AUTH_CACHE_TIMEOUT = 300
+
+# collection totals can be 'exact', 'estimate' (cached) or 'none'
+DEFAULT_COUNT_MODE = 'exact'
+COUNT_CACHE_TIMEOUT = 60
+
+# number of compiled filter and sort specifications that are cached
+QUERY_SPEC_CACHE_SIZE = 1000
+
+# what to do with filters and sorts that require a full table scan, such as
+# a like pattern with a leading wildcard or sorting on a column without an
+# index: 'allow', 'reject', or 'cost' to charge the request as
+# FULL_SCAN_COST calls to the rate limit, which are rejected if they exceed
+# the client's limit. Tables with fewer than FULL_SCAN_MIN_ROWS rows are not
+# checked
+FULL_SCAN_POLICY = 'cost'
+FULL_SCAN_COST = 5
+FULL_SCAN_MIN_ROWS = 10000
+
+# number of items inserted in each transaction by bulk requests
+BULK_CHUNK_SIZE = 500
+
+# number of rows fetched from the database at a time in streamed responses
+STREAM_YIELD_PER = 1000
+
+# users in these tiers can request large pages from collections, for
+# example to export them with a streamed response
+EXPORT_TIERS = ['premium']
+EXPORT_MAX_PER_PAGE = 100000
+
+# rate limits are stored in 'redis', or in the process 'memory' for single
+# process deployments
+USE_RATE_LIMITS = True
+RATELIMIT_BACKEND = 'redis'
+RATELIMIT_REDIS_URL = 'redis://localhost:6379/0'
+RATELIMIT_REDIS_MAX_CONNECTIONS = 50
+RATELIMIT_REDIS_TIMEOUT = 0.5
+
+# rate limits for each user tier, as (limit, period) for each group
+RATELIMIT_TIERS = {
+    'default': {'read': (5, 15), 'write': (5, 15)},
+    'premium': {'read': (50, 15), 'write': (20, 15)},
+}
+
+# groups of endpoints that share a rate limit, as (group, endpoints,
+# methods, cost) tuples. The first entry that matches the endpoint and
+# method of a request is used, with None matching everything. The cost is
+# the amount of the limit that each request consumes
+RATELIMIT_GROUPS = [
+    ('write', ['api.new_students', 'api.new_classes',
+               'api.new_registrations'], ['POST'], 5),
+    ('write', None, ['POST', 'PUT', 'DELETE'], 1),
+    ('read', None, None, 1),
+]
+
+# reserve rate limit quota from the backend in chunks of this size, to
+# reduce round trips to redis (0 to disable)
+RATELIMIT_RESERVE = 0
+
+# use the in-process rate limits if redis is not running
 try:
-    r = redis.Redis()
+    r = redis.Redis.from_url(RATELIMIT_REDIS_URL)
     r.ping()
-    USE_RATE_LIMITS = True
 except redis.ConnectionError:
-    USE_RATE_LIMITS = False
+    RATELIMIT_BACKEND = 'memory'
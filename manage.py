@@ -3,17 +3,18 @@ from flask import Flask, g, jsonify
 from flask.ext.script import Manager
 from api.app import create_app
 from api.models import db, User, Class
+from api import migrations
 
 manager = Manager(create_app)
 
 
 @manager.command
 def createdb(testdata=False):
+    """Create the database, or upgrade it to the latest schema."""
     app = create_app()
     with app.app_context():
-        db.drop_all()
-        db.create_all()
-        if testdata:
+        migrations.upgrade(db.engine)
+        if testdata and User.query.count() == 0:
             classes = ['Algebra', 'Literature', 'Chemistry', 'Spanish',
                        'Game Development', 'History', 'Music', 'Psychology',
                        'Science', 'Photography', 'Drama', 'Business',
@@ -27,6 +28,41 @@ def createdb(testdata=False):
 
             db.session.commit()
 
+
+@manager.command
+def upgrade(version=None):
+    """Upgrade the database schema to the latest or the given version."""
+    app = create_app()
+    with app.app_context():
+        applied = migrations.upgrade(
+            db.engine, int(version) if version is not None else None)
+        for v in applied:
+            print('Upgraded to version {0}.'.format(v))
+        print('The database is at version {0}.'.format(
+            migrations.current_version(db.engine)))
+
+
+@manager.command
+def downgrade(version):
+    """Downgrade the database schema to the given version."""
+    app = create_app()
+    with app.app_context():
+        for v in migrations.downgrade(db.engine, int(version)):
+            print('Reverted version {0}.'.format(v))
+        print('The database is at version {0}.'.format(
+            migrations.current_version(db.engine)))
+
+
+@manager.command
+def current():
+    """Show the version of the database schema."""
+    app = create_app()
+    with app.app_context():
+        print('The database is at version {0}, the latest version is '
+              '{1}.'.format(migrations.current_version(db.engine),
+                            migrations.get_migrations()[-1][0]))
+
+
 @manager.command
 def adduser(username):
     """Register a new user."""
@@ -36,7 +72,7 @@ def adduser(username):
     if password != password2:
         import sys
         sys.exit('Error: passwords do not match.')
-    db.create_all()
+    migrations.upgrade(db.engine)
     user = User(username=username, password=password)
     db.session.add(user)
     db.session.commit()
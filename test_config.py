@@ -1,5 +1,65 @@
 TESTING = True
 SECRET_KEY = 'secret'
 SQLALCHEMY_DATABASE_URI = 'sqlite://'
+SQLALCHEMY_POOL_SIZE = 10
+SQLALCHEMY_MAX_OVERFLOW = 10
+SQLALCHEMY_POOL_TIMEOUT = 10
+SQLALCHEMY_POOL_RECYCLE = 3600
+SQLALCHEMY_BINDS = {}
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_LAG = 5
+DATABASE_POOL_PRE_PING = True
+DATABASE_STATEMENT_TIMEOUT = 30
+SLOW_QUERY_LOG = None
+SLOW_QUERY_THRESHOLD = 0.5
+SLOW_QUERY_SAMPLE_RATE = 1.0
+SLOW_QUERY_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+SLOW_QUERY_LOG_PARAMETERS = False
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+USE_PROFILING = False
+PROFILING_SERVER_TIMING = True
+USE_METRICS = True
+ASYNC_MAX_CONNECTIONS = 10000
+JSON_SERIALIZER = 'auto'
 USE_TOKEN_AUTH = True
+TOKEN_SECRET_KEYS = [SECRET_KEY]
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+PASSWORD_HASH_POOL = None
+PASSWORD_HASH_WORKERS = 2
+CREDENTIALS_CACHE_TIMEOUT = 60
 USE_RATE_LIMITS = False
+RATELIMIT_BACKEND = 'redis'
+RATELIMIT_REDIS_URL = 'redis://localhost:6379/0'
+RATELIMIT_REDIS_MAX_CONNECTIONS = 50
+RATELIMIT_REDIS_TIMEOUT = 0.5
+RATELIMIT_TIERS = {
+    'default': {'read': (5, 15), 'write': (5, 15)},
+    'premium': {'read': (50, 15), 'write': (20, 15)},
+}
+RATELIMIT_GROUPS = [
+    ('write', ['api.new_students', 'api.new_classes',
+               'api.new_registrations'], ['POST'], 5),
+    ('write', None, ['POST', 'PUT', 'DELETE'], 1),
+    ('read', None, None, 1),
+]
+RATELIMIT_RESERVE = 0
+CACHE_TYPE = 'lru'
+CACHE_MAX_ITEMS = 1000
+CACHE_REDIS_URL = 'redis://localhost:6379/0'
+CACHE_TIMEOUT = 300
+LOCAL_CACHE_TIMEOUT = 5
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_TIMEOUT = 300
+AUTH_CACHE_TIMEOUT = 300
+DEFAULT_COUNT_MODE = 'exact'
+COUNT_CACHE_TIMEOUT = 60
+QUERY_SPEC_CACHE_SIZE = 1000
+FULL_SCAN_POLICY = 'cost'
+FULL_SCAN_COST = 5
+FULL_SCAN_MIN_ROWS = 10000
+BULK_CHUNK_SIZE = 2
+STREAM_YIELD_PER = 2
+EXPORT_TIERS = ['premium']
+EXPORT_MAX_PER_PAGE = 100000
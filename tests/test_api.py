@@ -1,9 +1,35 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
 import unittest
+from contextlib import contextmanager
+from json import dumps, loads
+from flask import url_for, g
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
 from werkzeug.exceptions import BadRequest
+from werkzeug.security import generate_password_hash
+from redis import BlockingConnectionPool
 from .test_client import TestClient
+import test_config
 from api.app import create_app
-from api.models import db, User
+from api.models import db, User, Student, Class, Registration
 from api.errors import ValidationError
+from api.rate_limit import FakeRedis, MemoryBackend, ReservingBackend, \
+    get_connection_pool
+from api.serializers import serializers
+from api.helpers import build_url, encode_cursor
+from api import migrations
+from api.database import StatsQueuePool, configure_engine, pool_stats
+from api.slow_queries import configure_slow_query_log
+from api.profiling import Profile
+from api.cache import get_cache, shared_timeout
+from api.migrations.operations import backfill
+from api.decorators import _compile_sort
 
 
 class TestAPI(unittest.TestCase):
@@ -406,6 +432,194 @@ class TestAPI(unittest.TestCase):
         rv, json = self.client.get(self.catalog['registrations_url'])
         self.assertTrue(rv.status_code == 429)
 
+    def test_rate_limit_backends(self):
+        self.app.config['USE_RATE_LIMITS'] = True
+        self.app.config['RATELIMIT_BACKEND'] = 'memory'
+
+        rv, json = self.client.get(self.catalog['registrations_url'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(isinstance(self.app.extensions['rate_limit_backend'],
+                                   MemoryBackend))
+        self.assertTrue(int(rv.headers['X-RateLimit-Limit']) == \
+            int(rv.headers['X-RateLimit-Remaining']) + 1)
+        while int(rv.headers['X-RateLimit-Remaining']) > 0:
+            rv, json = self.client.get(self.catalog['registrations_url'])
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(self.catalog['registrations_url'])
+        self.assertTrue(rv.status_code == 429)
+
+        # redis connections are taken from a blocking pool
+        pool = get_connection_pool('redis://localhost:6380/2', 10, 0.5)
+        self.assertTrue(isinstance(pool, BlockingConnectionPool))
+        self.assertTrue(pool.max_connections == 10)
+        self.assertTrue(pool.timeout == 0.5)
+        self.assertTrue(pool.connection_kwargs['port'] == 6380)
+        self.assertTrue(pool.connection_kwargs['db'] == 2)
+        self.assertTrue(pool.connection_kwargs['socket_timeout'] == 0.5)
+
+    def test_rate_limit_policies(self):
+        self.app.config['USE_RATE_LIMITS'] = True
+        students_url = self.catalog['students_url']
+
+        # a bulk request consumes the quota of five write requests
+        rv, json = self.client.post(students_url + 'bulk',
+                                    data=[{'name': 'susan'}])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '0')
+        rv, json = self.client.post(students_url, data={'name': 'david'})
+        self.assertTrue(rv.status_code == 429)
+
+        # read requests have their own limits
+        rv, json = self.client.get(students_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '4')
+
+        # users in a higher tier get larger limits
+        u = User.query.get(1)
+        u.tier = 'premium'
+        db.session.commit()
+        rv, json = self.client.get(students_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['X-RateLimit-Limit'] == '50')
+        self.assertTrue(int(rv.headers['X-RateLimit-Remaining']) > 5)
+
+    def test_rate_limit_reservations(self):
+        self.app.config['USE_RATE_LIMITS'] = True
+        self.app.config['RATELIMIT_RESERVE'] = 3
+
+        rv, json = self.client.get(self.catalog['registrations_url'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '4')
+        for i in range(4):
+            rv, json = self.client.get(self.catalog['registrations_url'])
+            self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '0')
+        rv, json = self.client.get(self.catalog['registrations_url'])
+        self.assertTrue(rv.status_code == 429)
+
+        # expired reservations are discarded when there are too many keys
+        backend = ReservingBackend(MemoryBackend(), 3)
+        backend.max_keys = 2
+        for key in ('a', 'b', 'c'):
+            self.assertTrue(backend.update(key, 100.0, 1.0, 10, 1)[0])
+        self.assertTrue(sorted(backend.reservations) == ['a', 'b', 'c'])
+        self.assertTrue(backend.update('d', 105.0, 1.0, 10, 1)[0])
+        self.assertTrue(len(backend.reservations) == 4)
+        self.assertTrue(backend.update('e', 111.0, 1.0, 10, 1)[0])
+        self.assertTrue(sorted(backend.reservations) == ['d', 'e'])
+
+    def test_fake_redis(self):
+        r = FakeRedis()
+        r.set('a', 1)
+        r.set('b', 2, px=50)
+        p = r.pipeline()
+        p.incr('c')
+        p.expire('c', 10)
+        self.assertTrue(p.execute() == [1, True])
+        self.assertTrue(r.get('a') == '1')
+        self.assertTrue(r.get('b') == '2')
+        self.assertTrue(r.ttl('a') == -1)
+        self.assertTrue(r.ttl('c') == 10)
+        time.sleep(0.1)
+        self.assertTrue(r.get('b') is None)
+        self.assertTrue(r.ttl('b') is None)
+        self.assertTrue(r.incr('a') == 2)
+        self.assertTrue(r.delete('a', 'b') == 1)
+
+    def test_json_serializers(self):
+        rv, json = self.client.post(self.catalog['students_url'],
+                                    data={'name': 'susan'})
+        self.assertTrue(rv.status_code == 201)
+        student_url = rv.headers['Location']
+
+        # API clients receive compact responses
+        rv, json = self.client.get(student_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(b'\n' not in rv.data)
+        self.assertTrue(b'": ' not in rv.data)
+        compact_etag = rv.headers['ETag']
+
+        # browsers receive indented responses, with their own ETag
+        rv, browser_json = self.client.get(student_url,
+                                           headers={'Accept': 'text/html'})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(b'\n' in rv.data)
+        self.assertTrue(browser_json == json)
+        self.assertTrue(rv.headers['ETag'] != compact_etag)
+
+        # all the serializers generate the same data
+        for name in serializers:
+            self.app.config['JSON_SERIALIZER'] = name
+            rv, serializer_json = self.client.get(
+                self.catalog['students_url'] + '?expand=1')
+            self.assertTrue(rv.status_code == 200)
+            self.assertTrue(serializer_json['students'][0] == json)
+
+    def test_streamed_collections(self):
+        students_url = self.catalog['students_url']
+        ndjson = {'Accept': 'application/x-ndjson'}
+        rv, json = self.client.post(students_url + 'bulk',
+                                    data=[{'name': 'student' + str(i)}
+                                          for i in range(25)])
+        self.assertTrue(rv.status_code == 200)
+
+        # a streamed page of URLs
+        rv, items = self.client.get(students_url, headers=ndjson)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.mimetype == 'application/x-ndjson')
+        self.assertTrue('ETag' not in rv.headers)
+        rv, json = self.client.get(students_url)
+        self.assertTrue(items == json['students'])
+
+        # a streamed page of expanded items, with filters and sorting
+        rv, items = self.client.get(
+            students_url + '?expand=1&sort=name,desc&page=2&per_page=5'
+            '&filter=name,like,student1%25', headers=ndjson)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([item['name'] for item in items] ==
+                        ['student14', 'student13', 'student12',
+                         'student11', 'student10'])
+
+        # regular users cannot get pages larger than the limit
+        rv, items = self.client.get(students_url + '?per_page=100',
+                                    headers=ndjson)
+        self.assertTrue(len(items) == 10)
+
+        # export users can get the whole collection in one request
+        u = User.query.get(1)
+        u.tier = 'premium'
+        db.session.commit()
+        rv, items = self.client.get(students_url + '?per_page=100',
+                                    headers=ndjson)
+        self.assertTrue(len(items) == 25)
+        rv, json = self.client.get(students_url + '?per_page=100')
+        self.assertTrue(len(json['students']) == 25)
+
+        # cursors cannot be used with streams
+        self.assertRaises(ValidationError,
+                          lambda: self.client.get(students_url + '?cursor=',
+                                                  headers=ndjson))
+
+    def test_url_templates(self):
+        for host in ['localhost', 'example.com:8080']:
+            with self.app.test_request_context(
+                    '/', base_url='https://' + host + '/api'):
+                for endpoint, values in [
+                        ('api.get_student', {'id': 12}),
+                        ('api.get_student', {'id': 345}),
+                        ('api.get_class_registrations', {'id': 6}),
+                        ('api.get_registration',
+                         {'student_id': 7, 'class_id': 89})]:
+                    self.assertTrue(
+                        build_url(endpoint, **values) ==
+                        url_for(endpoint, _external=True, **values))
+
+                # values that are not integers are passed to url_for()
+                self.assertTrue(build_url('api.get_students', page='2') ==
+                                url_for('api.get_students', page='2',
+                                        _external=True))
+        self.assertTrue(len(self.app.extensions['url_templates']) == 6)
+
     def test_expanded_collections(self):
         # create new students
         rv, json = self.client.post(self.catalog['students_url'],
@@ -511,6 +725,69 @@ class TestAPI(unittest.TestCase):
         self.assertTrue(json['students'] == [urls[1], urls[2], urls[0],
                                              urls[3], urls[4]])
 
+    def test_query_specs(self):
+        students_url = self.catalog['students_url']
+        for name in ['one', 'two', 'three']:
+            rv, json = self.client.post(students_url, data={'name': name})
+            self.assertTrue(rv.status_code == 201)
+
+        # columns that are not filterable or sortable are ignored
+        rv, json = self.client.get(students_url + '?filter=updated_at,eq,x'
+                                                  '&sort=updated_at,desc')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['students']) == 3)
+
+        # compiled specifications are cached
+        rv, json = self.client.get(students_url + '?filter=name,like,t%25'
+                                                  '&sort=name,desc')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['students']) == 2)
+        cache = self.app.extensions['query_specs']
+        self.assertTrue(cache.get(('_compile_sort', 'Student',
+                                   'name,desc')) == ([('name', True)], False))
+        self.assertTrue(cache.get(('_compile_filter', 'Student',
+                                   'name,like,t%')) ==
+                        ([('name', 'like', 't%')], False))
+
+        # full scans are accepted on small tables
+        rv, json = self.client.get(students_url + '?filter=name,like,%25e')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['students']) == 2)
+
+        # and rejected on large tables
+        self.app.config['FULL_SCAN_MIN_ROWS'] = 3
+        self.app.config['FULL_SCAN_POLICY'] = 'reject'
+        self.assertRaises(ValidationError,
+                          lambda: self.client.get(
+                              students_url + '?filter=name,like,%25n'))
+        self.app.config['FULL_SCAN_MIN_ROWS'] = 0
+        rv, json = self.client.get(self.catalog['registrations_url'] +
+                                   '?sort=class_id')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(_compile_sort(User, 'password_hash,desc') ==
+                        ([('password_hash', True)], True))
+        rv, json = self.client.get(students_url + '?filter=name,like,t%25'
+                                                  '&sort=name,desc')
+        self.assertTrue(rv.status_code == 200)
+
+        # or charged to the rate limits
+        self.app.config['FULL_SCAN_POLICY'] = 'cost'
+        self.app.config['USE_RATE_LIMITS'] = True
+        self.app.config['RATELIMIT_BACKEND'] = 'memory'
+        rv, json = self.client.get(students_url + '?filter=name,like,%25o')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['students']) == 1)
+        self.assertTrue(rv.headers['X-RateLimit-Remaining'] == '0')
+        rv, json = self.client.get(students_url + '?filter=name,like,%25w')
+        self.assertTrue(rv.status_code == 429)
+
+        # costs that exceed the rate limit are rejected
+        self.app.config['FULL_SCAN_COST'] = 6
+        del self.app.extensions['rate_limit_backend']
+        self.assertRaises(ValidationError,
+                          lambda: self.client.get(
+                              students_url + '?filter=name,like,%25h'))
+
     def test_pagination(self):
         urls = self._create_test_students()
 
@@ -552,6 +829,182 @@ class TestAPI(unittest.TestCase):
         self.assertTrue(urls[1] in json['students'])
         self.assertTrue(len(json['students']) == 1)
 
+    def test_pagination_counts(self):
+        urls = self._create_test_students()
+
+        # no count
+        rv, json = self.client.get(self.catalog['students_url'] +
+                                   '?page=2&per_page=2&count=none')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['students']) == 2)
+        self.assertFalse('total' in json['meta'])
+        self.assertFalse('last_url' in json['meta'])
+        self.assertTrue(json['meta']['prev_url'] is not None)
+        rv, json = self.client.get(json['meta']['next_url'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['students'] == [urls[4]])
+        self.assertTrue(json['meta']['next_url'] is None)
+
+        # estimated count
+        rv, json = self.client.get(self.catalog['students_url'] +
+                                   '?per_page=2&count=estimate')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['meta']['total'] == 5)
+        self.assertTrue(json['meta']['pages'] == 3)
+
+        # the cached count is discarded when the collection changes
+        rv, json = self.client.post(self.catalog['students_url'],
+                                    data={'name': 'six'})
+        self.assertTrue(rv.status_code == 201)
+        rv, json = self.client.get(self.catalog['students_url'] +
+                                   '?per_page=2&count=estimate')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['meta']['total'] == 6)
+        rv, json = self.client.get(self.catalog['students_url'] +
+                                   '?per_page=2&count=estimate'
+                                   '&filter=name,eq,six')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['meta']['total'] == 1)
+
+    def test_cursor_pagination(self):
+        urls = self._create_test_students()
+
+        # get the first page
+        rv, json = self.client.get(self.catalog['students_url'] +
+                                   '?cursor=&per_page=2&sort=name,asc')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['students'] == [urls[4], urls[3]])
+        self.assertFalse('total' in json['meta'])
+        self.assertTrue(json['meta']['prev_url'] is None)
+        first_url = json['meta']['first_url']
+        next_url = json['meta']['next_url']
+
+        rv, json = self.client.get(first_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['students'] == [urls[4], urls[3]])
+
+        # walk forward
+        rv, json = self.client.get(next_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['students'] == [urls[0], urls[2]])
+        next_url = json['meta']['next_url']
+
+        rv, json = self.client.get(next_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['students'] == [urls[1]])
+        self.assertTrue(json['meta']['next_url'] is None)
+        prev_url = json['meta']['prev_url']
+
+        # walk backwards
+        rv, json = self.client.get(prev_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['students'] == [urls[0], urls[2]])
+        prev_url = json['meta']['prev_url']
+
+        rv, json = self.client.get(prev_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['students'] == [urls[4], urls[3]])
+        self.assertTrue(json['meta']['prev_url'] is None)
+        self.assertTrue(json['meta']['next_url'] is not None)
+
+        # descending order on the primary key
+        rv, json = self.client.get(self.catalog['students_url'] +
+                                   '?cursor=&per_page=3&sort=id,desc')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['students'] == [urls[4], urls[3], urls[2]])
+        rv, json = self.client.get(json['meta']['next_url'])
+        self.assertTrue(json['students'] == [urls[1], urls[0]])
+
+        # bad cursor
+        self.assertRaises(ValidationError,
+                          lambda: self.client.get(
+                              self.catalog['students_url'] + '?cursor=foo'))
+
+        # cursor values that do not match the type of their columns
+        for values in [[[1]], ['1'], [True], [None], [1, 2]]:
+            self.assertRaises(ValidationError,
+                              lambda: self.client.get(
+                                  self.catalog['students_url'] + '?cursor=' +
+                                  encode_cursor('next', values)))
+        self.assertRaises(ValidationError,
+                          lambda: self.client.get(
+                              self.catalog['students_url'] +
+                              '?sort=name,asc&cursor=' +
+                              encode_cursor('next', [1, 1])))
+
+        # NULL values are sorted last in ascending order
+        null_urls = []
+        for i in range(2):
+            rv, json = self.client.post(self.catalog['students_url'],
+                                        data={'name': None})
+            self.assertTrue(rv.status_code == 201)
+            null_urls.append(rv.headers['Location'])
+        ascending = [urls[4], urls[3], urls[0], urls[2], urls[1]] + null_urls
+        for sort, expected in [('name,asc', ascending),
+                               ('name,desc', null_urls + ascending[4::-1])]:
+            pages = []
+            rv, json = self.client.get(self.catalog['students_url'] +
+                                       '?cursor=&per_page=2&sort=' + sort)
+            pages.append(json['students'])
+            while json['meta']['next_url']:
+                rv, json = self.client.get(json['meta']['next_url'])
+                self.assertTrue(rv.status_code == 200)
+                pages.append(json['students'])
+            self.assertTrue(sum(pages, []) == expected)
+            for page in reversed(pages[:-1]):
+                rv, json = self.client.get(json['meta']['prev_url'])
+                self.assertTrue(rv.status_code == 200)
+                self.assertTrue(json['students'] == page)
+
+    def test_response_cache(self):
+        rv, json = self.client.post(self.catalog['students_url'],
+                                    data={'name': 'one'})
+        self.assertTrue(rv.status_code == 201)
+        one_url = rv.headers['Location']
+        rv, json = self.client.post(self.catalog['classes_url'],
+                                    data={'name': 'algebra'})
+        self.assertTrue(rv.status_code == 201)
+        algebra_url = rv.headers['Location']
+
+        rv, json = self.client.get(one_url)
+        self.assertTrue(rv.status_code == 200)
+        one_etag = rv.headers['ETag']
+        rv, json = self.client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(algebra_url)
+        algebra_registrations_url = json['registrations_url']
+        rv, json = self.client.get(algebra_registrations_url)
+        self.assertTrue(rv.status_code == 200)
+
+        # changes made outside of the ORM are not seen until the cache is
+        # invalidated
+        db.session.execute("UPDATE students SET name = 'one-sql'")
+        db.session.commit()
+        rv, json = self.client.get(one_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['name'] == 'one')
+        self.assertTrue(rv.headers['ETag'] == one_etag)
+        rv, json = self.client.get(one_url, headers={
+            'If-None-Match': one_etag})
+        self.assertTrue(rv.status_code == 304)
+        rv, json = self.client.get(self.catalog['students_url'] +
+                                   '?expand=1')
+        self.assertTrue(json['students'][0]['name'] == 'one-sql')
+
+        # changes made through the API invalidate the cached responses
+        rv, json = self.client.put(one_url, data={'name': 'two'})
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(one_url)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['name'] == 'two')
+        self.assertTrue(rv.headers['ETag'] != one_etag)
+
+        # deleting a resource invalidates its nested collections
+        rv, json = self.client.delete(algebra_url)
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(algebra_registrations_url)
+        self.assertTrue(rv.status_code == 404)
+
     def test_etag(self):
         # create two students
         rv, json = self.client.post(self.catalog['students_url'],
@@ -609,3 +1062,850 @@ class TestAPI(unittest.TestCase):
         rv, json = self.client.get(one_url, headers={
             'If-None-Match': one_etag})
         self.assertTrue(rv.status_code == 200)
+
+    def test_version_etag(self):
+        self.app.config['USE_RESPONSE_CACHE'] = False
+        rv, json = self.client.post(self.catalog['students_url'],
+                                    data={'name': 'one'})
+        self.assertTrue(rv.status_code == 201)
+        one_url = rv.headers['Location']
+
+        rv, json = self.client.get(one_url)
+        self.assertTrue(rv.status_code == 200)
+        one_etag = rv.headers['ETag']
+        rv, json = self.client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 200)
+        students_etag = rv.headers['ETag']
+
+        # the etags depend on the modification time of the resources and
+        # not on their contents
+        db.session.execute("UPDATE students SET name = 'one-sql'")
+        db.session.commit()
+        rv, json = self.client.get(one_url, headers={
+            'If-None-Match': one_etag})
+        self.assertTrue(rv.status_code == 304)
+        self.assertTrue(rv.headers['ETag'] == one_etag)
+        rv, json = self.client.get(self.catalog['students_url'], headers={
+            'If-None-Match': students_etag})
+        self.assertTrue(rv.status_code == 304)
+        rv, json = self.client.get(self.catalog['students_url'], headers={
+            'If-Match': '"foo"'})
+        self.assertTrue(rv.status_code == 412)
+
+        # modify the resource
+        rv, json = self.client.put(one_url, data={'name': 'two'})
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(one_url, headers={
+            'If-None-Match': one_etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.headers['ETag'] != one_etag)
+        rv, json = self.client.get(self.catalog['students_url'], headers={
+            'If-None-Match': students_etag})
+        self.assertTrue(rv.status_code == 200)
+        students_etag = rv.headers['ETag']
+
+        # add a resource to the collection
+        rv, json = self.client.post(self.catalog['students_url'],
+                                    data={'name': 'three'})
+        self.assertTrue(rv.status_code == 201)
+        rv, json = self.client.get(self.catalog['students_url'], headers={
+            'If-None-Match': students_etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['students']) == 2)
+
+    def test_bulk_create(self):
+        # create students in bulk
+        rv, json = self.client.post(self.catalog['students_url'] + 'bulk',
+                                    data=[{'name': 'susan'},
+                                          {'name': 'david'},
+                                          {'foo': 'bar'},
+                                          {'name': 'mary'}])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([item['status'] for item in json['items']] ==
+                        [201, 201, 400, 201])
+        susan_url = json['items'][0]['location']
+        david_url = json['items'][1]['location']
+        rv, json = self.client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['students']) == 3)
+        self.assertTrue(susan_url in json['students'])
+
+        # the request must be a list
+        self.assertRaises(ValidationError,
+                          lambda: self.client.post(
+                              self.catalog['students_url'] + 'bulk',
+                              data={'name': 'susan'}))
+
+        # create classes in bulk
+        rv, json = self.client.post(self.catalog['classes_url'] + 'bulk',
+                                    data=[{'name': 'algebra'}])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['items'][0]['status'] == 201)
+        algebra_url = json['items'][0]['location']
+
+        # create registrations with newline delimited JSON
+        body = '\n'.join([
+            dumps({'student_url': susan_url, 'class_url': algebra_url}),
+            dumps({'student_url': susan_url, 'class_url': susan_url}),
+            dumps({'student_url': david_url, 'class_url': algebra_url}),
+            dumps({'student_url': 5, 'class_url': algebra_url}),
+            dumps({'student_url': susan_url, 'class_url': [algebra_url]}),
+            'not json'])
+        rv, json = self.client.send(self.catalog['registrations_url'] +
+                                    'bulk', 'POST', body,
+                                    content_type='application/x-ndjson')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([item['status'] for item in json['items']] ==
+                        [201, 400, 201, 400, 400, 400])
+        self.assertTrue(json['items'][3]['message'] == 'Invalid student URL')
+        rv, json = self.client.get(json['items'][0]['location'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['student_url'] == susan_url)
+        rv, json = self.client.get(self.catalog['registrations_url'])
+        self.assertTrue(len(json['registrations']) == 2)
+
+        # duplicated registrations
+        rv, json = self.client.post(self.catalog['registrations_url'] +
+                                    'bulk',
+                                    data=[{'student_url': susan_url,
+                                           'class_url': algebra_url}])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['items'][0]['status'] == 409)
+
+        # only the conflicting items of a chunk are rejected
+        rv, json = self.client.post(self.catalog['classes_url'] + 'bulk',
+                                    data=[{'name': 'lit'}])
+        lit_url = json['items'][0]['location']
+        rv, json = self.client.post(self.catalog['registrations_url'] +
+                                    'bulk',
+                                    data=[{'student_url': susan_url,
+                                           'class_url': algebra_url},
+                                          {'student_url': susan_url,
+                                           'class_url': lit_url},
+                                          {'student_url': david_url,
+                                           'class_url': lit_url},
+                                          {'student_url': david_url,
+                                           'class_url': lit_url}])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([item['status'] for item in json['items']] ==
+                        [409, 201, 201, 409])
+        rv, json2 = self.client.get(json['items'][1]['location'])
+        self.assertTrue(rv.status_code == 200)
+        rv, json2 = self.client.get(self.catalog['registrations_url'])
+        self.assertTrue(len(json2['registrations']) == 4)
+
+    @contextmanager
+    def _capture_statements(self, predicate, parameters=False):
+        # collect the statements that match the predicate issued within the
+        # block, as (statement, parameters, executemany) tuples if the
+        # parameters are requested
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, params, context,
+                                  executemany):
+            if predicate(statement):
+                statements.append((statement, params, executemany)
+                                  if parameters else statement)
+
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+    def _capture_selects(self, url, headers={}):
+        with self._capture_statements(
+                lambda statement: statement.startswith('SELECT')) \
+                as statements:
+            rv, json = self.client.get(url, headers=headers)
+        return rv, json, statements
+
+    def test_bulk_registration_queries(self):
+        rv, json = self.client.post(self.catalog['students_url'] + 'bulk',
+                                    data=[{'name': 'susan'},
+                                          {'name': 'david'}])
+        student_urls = [item['location'] for item in json['items']]
+        rv, json = self.client.post(self.catalog['classes_url'] + 'bulk',
+                                    data=[{'name': 'algebra'},
+                                          {'name': 'lit'}])
+        class_urls = [item['location'] for item in json['items']]
+        registrations = [{'student_url': student_url, 'class_url': class_url}
+                         for student_url in student_urls
+                         for class_url in class_urls]
+
+        # count the queries issued for students and classes
+        with self._capture_statements(
+                lambda statement: statement.startswith('SELECT') and
+                'FROM registrations' not in statement) as statements:
+            rv, json = self.client.post(self.catalog['registrations_url'] +
+                                        'bulk', data=registrations)
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([item['status'] for item in json['items']] ==
+                        [201, 201, 201, 201])
+
+        # students and classes are loaded once for each of the two chunks
+        self.assertTrue(len(statements) == 4)
+
+    def test_loader_options(self):
+        rv, json = self.client.post(self.catalog['students_url'] + 'bulk',
+                                    data=[{'name': 'one'}, {'name': 'two'},
+                                          {'name': 'three'}])
+        student_urls = [item['location'] for item in json['items']]
+        rv, json = self.client.post(self.catalog['classes_url'] + 'bulk',
+                                    data=[{'name': 'algebra'},
+                                          {'name': 'lit'}])
+        class_urls = [item['location'] for item in json['items']]
+        rv, json = self.client.post(
+            self.catalog['registrations_url'] + 'bulk',
+            data=[{'student_url': student_url, 'class_url': class_url}
+                  for student_url in student_urls
+                  for class_url in class_urls])
+        self.assertTrue(rv.status_code == 200)
+        registrations_url = self.catalog['registrations_url']
+
+        # listings only load the key columns of the items
+        rv, json, statements = self._capture_selects(
+            registrations_url + '?count=none')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['registrations']) == 6)
+        self.assertTrue(len(statements) == 1)
+        self.assertTrue('JOIN' not in statements[0])
+        self.assertTrue('registrations.timestamp' not in statements[0])
+        self.assertTrue('registrations.student_id' in statements[0])
+
+        # sort columns are loaded to generate cursors
+        rv, json, statements = self._capture_selects(
+            registrations_url + '?cursor=&per_page=4&sort=timestamp,desc')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(statements) == 1)
+        self.assertTrue('registrations.timestamp' in statements[0])
+        rv, json2 = self.client.get(json['meta']['next_url'])
+        self.assertTrue(len(json['registrations'] + json2['registrations'])
+                        == 6)
+
+        # expanded items do not join the related resources
+        rv, json, statements = self._capture_selects(
+            registrations_url + '?count=none&expand=1')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(statements) == 1)
+        self.assertTrue('JOIN' not in statements[0])
+        self.assertTrue('student' not in json['registrations'][0])
+
+        # nested expansion loads the related resources in batches
+        rv, json, statements = self._capture_selects(
+            registrations_url + '?count=none&expand=student,class')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(statements) == 3)
+        self.assertTrue('JOIN' not in statements[0])
+        for reg in json['registrations']:
+            self.assertTrue(reg['student']['self_url'] == reg['student_url'])
+            self.assertTrue(reg['class']['self_url'] == reg['class_url'])
+        self.assertTrue(sorted(set(reg['student']['name']
+                                   for reg in json['registrations'])) ==
+                        ['one', 'three', 'two'])
+
+        rv, json = self.client.get(student_urls[0].replace('http://localhost',
+                                                           '') +
+                                   '/registrations/?expand=class')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([reg['class']['name'] for reg in json[
+            'registrations']] == ['algebra', 'lit'])
+        self.assertRaises(ValidationError, lambda: self.client.get(
+            registrations_url + '?expand=classes'))
+        self.assertRaises(ValidationError, lambda: self.client.get(
+            self.catalog['students_url'] + '?expand=class'))
+
+        # streamed items are expanded as well
+        rv, items = self.client.get(registrations_url + '?expand=student',
+                                    headers={'Accept': 'application/x-ndjson'})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(items) == 6)
+        self.assertTrue(all(item['student']['self_url'] ==
+                            item['student_url'] for item in items))
+
+    def test_expanded_resource_versions(self):
+        rv, json = self.client.post(self.catalog['students_url'],
+                                    data={'name': 'one'})
+        student_url = rv.headers['Location']
+        rv, json = self.client.post(self.catalog['classes_url'],
+                                    data={'name': 'algebra'})
+        class_url = rv.headers['Location']
+        rv, json = self.client.post(self.catalog['registrations_url'],
+                                    data={'student_url': student_url,
+                                          'class_url': class_url})
+        self.assertTrue(rv.status_code == 201)
+        url = self.catalog['registrations_url'] + '?expand=student'
+
+        # cached responses change when an expanded resource changes
+        rv, json = self.client.get(url)
+        self.assertTrue(json['registrations'][0]['student']['name'] == 'one')
+        etag = rv.headers['ETag']
+        time.sleep(0.01)
+        rv, json = self.client.put(student_url, data={'name': 'uno'})
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(url)
+        self.assertTrue(json['registrations'][0]['student']['name'] == 'uno')
+        self.assertTrue(rv.headers['ETag'] != etag)
+
+        # so does the version of the collection
+        self.app.config['USE_RESPONSE_CACHE'] = False
+        etag = rv.headers['ETag']
+        time.sleep(0.01)
+        rv, json = self.client.put(student_url, data={'name': 'eins'})
+        rv, json = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['registrations'][0]['student']['name'] ==
+                        'eins')
+        rv, json = self.client.get(url, headers={
+            'If-None-Match': rv.headers['ETag']})
+        self.assertTrue(rv.status_code == 304)
+
+    def _query_plans(self, url, method='GET'):
+        # return the query plans of the statements issued by a request
+        with self._capture_statements(
+                lambda statement: statement.startswith(('SELECT', 'DELETE')),
+                parameters=True) as statements:
+            rv, json = self.client.send(url, method)
+        self.assertTrue(rv.status_code in [200, 204])
+        # statements executed with several sets of parameters are explained
+        # with the first one, as EXPLAIN cannot run as an executemany
+        return [(statement, ' '.join(str(row[-1]) for row in db.engine.execute(
+                'EXPLAIN QUERY PLAN ' + statement,
+                parameters[0] if executemany else parameters)))
+                for statement, parameters, executemany in statements]
+
+    def test_query_plans(self):
+        self.app.config['USE_RESPONSE_CACHE'] = False
+        db.session.execute(Student.__table__.insert(),
+                           [{'id': i, 'name': 'student' + str(i)}
+                            for i in range(1, 101)])
+        db.session.execute(Class.__table__.insert(),
+                           [{'id': i, 'name': 'class' + str(i)}
+                            for i in range(1, 21)])
+        db.session.execute(Registration.__table__.insert(),
+                           [{'student_id': i, 'class_id': j,
+                             'timestamp': datetime.utcnow(),
+                             'updated_at': datetime.utcnow()}
+                            for i in range(1, 101) for j in range(1, 21)])
+        db.session.commit()
+
+        class_url = self.catalog['classes_url'] + '5'
+        for url, method in [
+                (class_url + '/registrations/', 'GET'),
+                (class_url + '/registrations/?expand=1&sort=timestamp,desc',
+                 'GET'),
+                (self.catalog['registrations_url'] +
+                 '?sort=timestamp,desc&count=none', 'GET'),
+                (self.catalog['students_url'] + '5/registrations/', 'GET'),
+                (class_url, 'DELETE')]:
+            plans = self._query_plans(url, method)
+            for statement, plan in plans:
+                # full scans of the registrations table are reported as
+                # "SCAN registrations" without an index
+                self.assertTrue('SCAN registrations' not in plan or
+                                'INDEX' in plan, url + ': ' + plan)
+
+        # the registrations of the deleted class are found with an index
+        plans = [plan for statement, plan in plans
+                 if statement.startswith('DELETE FROM registrations')]
+        self.assertTrue(len(plans) == 1 and 'INDEX' in plans[0])
+
+    def test_migrations(self):
+        engine = create_engine('sqlite://')
+        self.assertTrue(migrations.current_version(engine) == 0)
+        self.assertTrue(migrations.upgrade(engine, 1) == [1])
+        self.assertTrue(migrations.current_version(engine) == 1)
+        engine.execute("INSERT INTO students (id, name) VALUES (1, 'susan')")
+        engine.execute("INSERT INTO classes (id, name) VALUES (1, 'algebra')")
+        engine.execute("INSERT INTO registrations VALUES "
+                       "(1, 1, '2014-05-01 10:00:00.000000')")
+        engine.execute("INSERT INTO users (id, username) VALUES (1, 'dave')")
+
+        self.assertTrue(migrations.upgrade(engine, 2) == [2])
+        self.assertTrue(migrations.current_version(engine) == 2)
+        indexes = [index['name'] for index in
+                   inspect(engine).get_indexes('registrations')]
+        self.assertTrue('ix_registrations_class_id' in indexes)
+        self.assertTrue('ix_registrations_timestamp' in indexes)
+
+        # new columns are backfilled
+        self.assertTrue(migrations.upgrade(engine) == [3])
+        self.assertTrue(migrations.upgrade(engine) == [])
+        self.assertTrue(engine.execute(
+            'SELECT timestamp = updated_at FROM registrations').scalar())
+        self.assertTrue(engine.execute(
+            'SELECT updated_at FROM students').scalar() is not None)
+        self.assertTrue(engine.execute(
+            'SELECT tier FROM users').scalar() == 'default')
+
+        self.assertTrue(migrations.downgrade(engine, 1) == [3, 2])
+        self.assertTrue(inspect(engine).get_indexes('registrations') == [])
+        self.assertTrue('updated_at' not in [
+            c['name'] for c in inspect(engine).get_columns('students')])
+        self.assertTrue(migrations.downgrade(engine, 0) == [1])
+        self.assertTrue(migrations.current_version(engine) == 0)
+        self.assertTrue(inspect(engine).get_table_names() ==
+                        ['schema_version'])
+
+        # databases created with create_all() can be migrated
+        self.assertTrue(migrations.upgrade(db.engine) == [1, 2, 3])
+
+    def test_backfill(self):
+        db.session.execute(Student.__table__.insert(),
+                           [{'id': i, 'name': 'student' + str(i),
+                             'updated_at': None} for i in range(1, 8)])
+        db.session.commit()
+        with self._capture_statements(
+                lambda statement: statement.startswith('UPDATE')) \
+                as statements:
+            with db.engine.connect() as connection:
+                total = backfill(connection, Student.__table__,
+                                 Student.__table__.c.updated_at,
+                                 datetime(2014, 1, 1), batch_size=3)
+        self.assertTrue(total == 7)
+        self.assertTrue(len(statements) == 3)
+        self.assertTrue(Student.query.filter_by(
+            updated_at=datetime(2014, 1, 1)).count() == 7)
+
+        # values that are NULL are replaced with the default
+        db.session.execute(Student.__table__.update().where(
+            Student.id > 4).values(name=None))
+        db.session.commit()
+        name = Student.__table__.c.name
+        with db.engine.connect() as connection:
+            backfill(connection, Student.__table__, name, name, batch_size=2)
+            self.assertTrue(Student.query.filter_by(name=None).count() == 3)
+            backfill(connection, Student.__table__, name, name,
+                     default='unknown', batch_size=2)
+        self.assertTrue(Student.query.filter_by(name='unknown').count() == 3)
+
+    def test_database_config(self):
+        self.assertTrue(db.session.execute(
+            'PRAGMA synchronous').scalar() == 1)
+
+        # long statements are interrupted
+        engine = create_engine('sqlite://')
+        config = dict(self.app.config)
+        config['DATABASE_STATEMENT_TIMEOUT'] = 0.05
+        configure_engine(engine, config)
+        slow_query = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                      'SELECT i + 1 FROM n WHERE i < 100000000) '
+                      'SELECT count(*) FROM n')
+        self.assertRaises(OperationalError,
+                          lambda: engine.execute(slow_query).scalar())
+        self.assertTrue(engine.execute('SELECT 1').scalar() == 1)
+
+    def test_slow_query_log(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config = dict(self.app.config)
+            config['SLOW_QUERY_LOG'] = os.path.join(tmpdir, 'slow.log')
+            config['SLOW_QUERY_THRESHOLD'] = 0
+            configure_slow_query_log(db.engine, config)
+            for name in ['one', 'two', 'three']:
+                db.session.add(Student(name=name))
+            db.session.commit()
+
+            rv, json = self.client.get(self.catalog['students_url'] +
+                                       '?filter=name,ne,two&sort=name,asc'
+                                       '&page=1&expand=1')
+            self.assertTrue(rv.status_code == 200)
+            self.assertTrue([s['name'] for s in json['students']] ==
+                            ['one', 'three'])
+            with open(config['SLOW_QUERY_LOG']) as f:
+                entries = [loads(line) for line in f]
+            entries = [e for e in entries
+                       if e.get('endpoint') == 'api.get_students' and
+                       'LIMIT' in e['statement']]
+            self.assertTrue(len(entries) == 1)
+            entry = entries[0]
+            self.assertTrue(entry['method'] == 'GET')
+            self.assertTrue(entry['collection'] == {
+                'filter': 'name,ne,two', 'sort': 'name,asc', 'page': '1',
+                'expand': '1'})
+            self.assertTrue('SCAN' in ' '.join(
+                ' '.join(row) for row in entry['plan']))
+            self.assertTrue('parameters' not in entry)
+
+            # statements below the threshold or not sampled are not logged
+            engine = create_engine('sqlite://')
+            config['SLOW_QUERY_LOG'] = os.path.join(tmpdir, 'sampled.log')
+            config['SLOW_QUERY_SAMPLE_RATE'] = 0
+            configure_slow_query_log(engine, config)
+            engine.execute('SELECT 1')
+            config['SLOW_QUERY_SAMPLE_RATE'] = 1
+            config['SLOW_QUERY_THRESHOLD'] = 10
+            configure_slow_query_log(engine, config)
+            engine.execute('SELECT 1')
+            self.assertTrue(os.path.getsize(config['SLOW_QUERY_LOG']) == 0)
+
+            # the log is rotated
+            engine = create_engine('sqlite://')
+            config['SLOW_QUERY_LOG'] = os.path.join(tmpdir, 'rotated.log')
+            config['SLOW_QUERY_THRESHOLD'] = 0
+            config['SLOW_QUERY_LOG_MAX_BYTES'] = 100
+            config['SLOW_QUERY_LOG_BACKUPS'] = 2
+            config['SLOW_QUERY_LOG_PARAMETERS'] = True
+            configure_slow_query_log(engine, config)
+            for i in range(5):
+                self.assertTrue(engine.execute('SELECT ?', i).scalar() == i)
+            self.assertTrue([name for name in sorted(os.listdir(tmpdir))
+                             if name.startswith('rotated')] == [
+                'rotated.log', 'rotated.log.1', 'rotated.log.2'])
+            with open(config['SLOW_QUERY_LOG']) as f:
+                entry = loads(f.read())
+            self.assertTrue(entry['parameters'] == '(4,)')
+            self.assertTrue(entry['plan'] is not None)
+
+            # without a size limit the log is reopened when it is moved
+            engine = create_engine('sqlite://')
+            config['SLOW_QUERY_LOG'] = os.path.join(tmpdir, 'watched.log')
+            config['SLOW_QUERY_LOG_MAX_BYTES'] = 0
+            configure_slow_query_log(engine, config)
+            engine.execute('SELECT 1')
+            os.rename(config['SLOW_QUERY_LOG'],
+                      config['SLOW_QUERY_LOG'] + '.1')
+            engine.execute('SELECT 2')
+            for name, value in [('watched.log.1', 1), ('watched.log', 2)]:
+                with open(os.path.join(tmpdir, name)) as f:
+                    entries = [loads(line) for line in f]
+                self.assertTrue([e['parameters'] for e in entries] == ['()'])
+                self.assertTrue(entries[0]['statement'] ==
+                                'SELECT {0}'.format(value))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_pool_stats(self):
+        rv, json = self.client.get('/stats/database')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['pool']['pool'] == 'StaticPool')
+
+        engine = create_engine('sqlite://', poolclass=StatsQueuePool,
+                               pool_size=1, max_overflow=0)
+        conn = engine.connect()
+        stats = pool_stats(engine)
+        self.assertTrue(stats['checked_out'] == 1)
+        self.assertTrue(stats['waits'] == 0)
+
+        # a second connection has to wait for the first one to be returned
+        timer = threading.Timer(0.05, conn.close)
+        timer.start()
+        engine.connect().close()
+        timer.join()
+        stats = pool_stats(engine)
+        self.assertTrue(stats['checked_out'] == 0)
+        self.assertTrue(stats['checked_in'] == 1)
+        self.assertTrue(stats['waits'] == 1)
+        self.assertTrue(stats['wait_time'] > 0)
+
+        # pooled connections are tested before they are used
+        options = {}
+        db.apply_driver_hacks(self.app, make_url('postgresql://db/api'),
+                              options)
+        self.assertTrue(options['poolclass'] == StatsQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+
+    def test_profiling(self):
+        for i in range(3):
+            rv, json = self.client.post(self.catalog['students_url'],
+                                        data={'name': 'student' + str(i)})
+            self.assertTrue(rv.status_code == 201)
+
+        # profiling is disabled by default
+        rv, json = self.client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue('Server-Timing' not in rv.headers)
+
+        self.app.config['USE_PROFILING'] = True
+        rv, json = self.client.get(self.catalog['students_url'] +
+                                   '?expand=1')
+        self.assertTrue(rv.status_code == 200)
+        metrics = dict((metric.split(';')[0], metric.split(';')[1:])
+                       for metric in rv.headers['Server-Timing'].split(', '))
+        for stage in ['auth', 'view', 'count', 'paginate', 'export',
+                      'serialize', 'etag', 'sql', 'total']:
+            self.assertTrue(stage in metrics)
+            self.assertTrue(metrics[stage][0].startswith('dur='))
+        sql_count = int(metrics['sql'][1].split('"')[1].split()[0])
+        self.assertTrue(sql_count >= 2)
+
+        # the timings are aggregated by endpoint
+        self.app.config['PROFILING_SERVER_TIMING'] = False
+        rv, json = self.client.get('/stats/requests')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue('Server-Timing' not in rv.headers)
+        stats = json['endpoints']['api.get_students']
+        self.assertTrue(stats['durations']['total']['count'] == 1)
+        self.assertTrue(stats['durations']['total']['buckets'][-1] ==
+                        [None, 1])
+        self.assertTrue(stats['queries']['count'] == 1)
+        self.assertTrue(stats['queries']['sum'] == sql_count)
+        rv, json = self.client.get('/stats/requests')
+        self.assertTrue(
+            json['endpoints']['stats.get_request_stats']['queries']
+            ['count'] == 1)
+
+        # statements that fail are not timed
+        with self.app.test_request_context():
+            g.profile = profile = Profile()
+            with db.engine.connect() as connection:
+                self.assertRaises(OperationalError,
+                                  lambda: connection.execute('SELECT foo'))
+                connection.execute('SELECT 1')
+                self.assertTrue(profile.stages['sql'][0] == 1)
+                self.assertFalse('profile_start' in connection.info)
+
+    def _get_metrics(self):
+        rv = self.app.test_client().get(
+            '/stats/metrics', headers={'Authorization': self.client.auth})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.mimetype == 'text/plain')
+        metrics = {}
+        for line in rv.data.decode('utf-8').splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                metrics[name] = float(value)
+        return metrics
+
+    def test_metrics(self):
+        self.app.config['USE_RATE_LIMITS'] = True
+        self.app.config['RATELIMIT_BACKEND'] = 'memory'
+        rv, json = self.client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get(self.catalog['students_url'], headers={
+            'If-None-Match': rv.headers['ETag']})
+        self.assertTrue(rv.status_code == 304)
+        while rv.status_code != 429:
+            rv, json = self.client.get(self.catalog['students_url'])
+
+        metrics = self._get_metrics()
+        requests = 'api_requests_total{{endpoint="api.get_students",' \
+            'method="GET",status="{0}"}}'
+        self.assertTrue(metrics[requests.format(304)] == 1)
+        self.assertTrue(metrics[requests.format(429)] == 1)
+        self.assertTrue(metrics['api_rate_limited_total{group="read"}'] == 1)
+        count = metrics['api_request_duration_seconds_count'
+                        '{endpoint="api.get_students"}']
+        self.assertTrue(count == sum(
+            value for name, value in metrics.items()
+            if name.startswith('api_requests_total{endpoint='
+                               '"api.get_students"')))
+        self.assertTrue(metrics['api_request_duration_seconds_bucket'
+                                '{endpoint="api.get_students",le="+Inf"}'] ==
+                        count)
+        self.assertTrue(metrics['api_response_cache_total{result="hit"}'] >= 1)
+        self.assertTrue(
+            metrics['api_auth_cache_total{cache="user",result="hit"}'] >= 1)
+
+        # metrics recorded in other threads are merged
+        self.app.config['USE_RATE_LIMITS'] = False
+        def request():
+            with self.app.test_request_context():
+                self.client.get(self.catalog['classes_url'])
+        threads = [threading.Thread(target=request) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics = self._get_metrics()
+        self.assertTrue(metrics['api_requests_total{endpoint='
+                                '"api.get_classes",method="GET",'
+                                'status="200"}'] == 3)
+
+        self.app.config['USE_METRICS'] = False
+        metrics = self._get_metrics()
+        rv, json = self.client.get(self.catalog['classes_url'])
+        self.assertTrue(self._get_metrics() == metrics)
+
+    def test_read_replicas(self):
+        tmpdir = tempfile.mkdtemp()
+        config = dict((key, getattr(test_config, key))
+                      for key in dir(test_config) if key.isupper())
+        config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(tmpdir, 'primary.sqlite')
+        config['SQLALCHEMY_BINDS'] = {
+            'replica': 'sqlite:///' + os.path.join(tmpdir, 'replica.sqlite')}
+        config['DATABASE_REPLICAS'] = ['replica']
+        config['USE_TOKEN_AUTH'] = False
+        app = create_app(type('ReplicaConfig', (object,), config))
+        ctx = app.app_context()
+        ctx.push()
+        try:
+            # the replica starts as a copy of the primary database. The
+            # passwords are hashed with the configured method, so that they
+            # are not rehashed, which would be a write
+            replica = db.get_engine(app, 'replica')
+            method = config['PASSWORD_HASH_METHOD']
+            for engine in [db.engine, replica]:
+                db.metadata.create_all(engine)
+                engine.execute(User.__table__.insert(), [
+                    {'id': 1, 'username': 'dave', 'tier': 'default',
+                     'password_hash': generate_password_hash('cat', method)},
+                    {'id': 2, 'username': 'susan', 'tier': 'default',
+                     'password_hash': generate_password_hash('dog', method)}])
+            client = TestClient(app, 'dave', 'cat')
+            other_client = TestClient(app, 'susan', 'dog')
+            catalog = client.get('/')[1]['versions']['v1']
+
+            # writes go to the primary, and reads go to the primary while
+            # the replica may be behind
+            rv, json = client.post(catalog['students_url'],
+                                   data={'name': 'susan'})
+            self.assertTrue(rv.status_code == 201)
+            rv, json = client.get(catalog['students_url'])
+            self.assertTrue(len(json['students']) == 1)
+
+            # other clients keep reading from the replica
+            rv, json = other_client.get(catalog['students_url'])
+            self.assertTrue(len(json['students']) == 0)
+
+            # once the lag period is over reads go to the replica
+            app.extensions['api_cache'].delete('replica:last_write:1')
+            rv, json = client.get(catalog['students_url'])
+            self.assertTrue(len(json['students']) == 0)
+            replica.execute(Student.__table__.insert(), id=1, name='susan')
+            rv, json = client.get(catalog['students_url'])
+            self.assertTrue(len(json['students']) == 1)
+
+            # the replica is not used again until the lag period is over
+            rv, json = client.put(catalog['students_url'] + '1',
+                                  data={'name': 'david'})
+            self.assertTrue(rv.status_code == 200)
+            rv, json = client.get(catalog['students_url'] + '1')
+            self.assertTrue(json['name'] == 'david')
+
+            # responses read from the replica while it may be behind are
+            # not cached, so other clients see the change once it arrives.
+            # The requests of this test share the session, which is cleared
+            # so that students are not taken from its identity map
+            def get_student():
+                db.session.remove()
+                return other_client.get(catalog['students_url'] + '1')[1]
+            self.assertTrue(get_student()['name'] == 'susan')
+            replica.execute(Student.__table__.update().values(name='david'))
+            self.assertTrue(get_student()['name'] == 'david')
+
+            # responses are cached again once the lag period is over
+            app.extensions['api_cache'].delete('replica:last_write')
+            app.extensions['api_cache'].delete('replica:last_write:1')
+            self.assertTrue(get_student()['name'] == 'david')
+            replica.execute(Student.__table__.update().values(name='eve'))
+            self.assertTrue(get_student()['name'] == 'david')
+        finally:
+            db.session.remove()
+            ctx.pop()
+            shutil.rmtree(tmpdir)
+
+    def test_auth_cache(self):
+        # count the queries issued for users
+        with self._capture_statements(
+                lambda statement: 'FROM users' in statement) as statements:
+            rv, json = self.client.get(self.catalog['students_url'])
+            self.assertTrue(rv.status_code == 200)
+            rv, json = self.client.get(self.catalog['classes_url'])
+            self.assertTrue(rv.status_code == 200)
+            self.assertTrue(len(statements) == 0)
+
+            # changes to the user invalidate the cached record
+            u = User.query.get(1)
+            u.username = 'susan'
+            db.session.commit()
+            del statements[:]
+            rv, json = self.client.get(self.catalog['students_url'])
+            self.assertTrue(rv.status_code == 200)
+            self.assertTrue(len(statements) == 1)
+
+        # deleted users cannot authenticate with their tokens
+        db.session.delete(User.query.get(1))
+        db.session.commit()
+        rv, json = self.client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 401)
+
+    def test_local_cache_timeout(self):
+        # other processes do not see the invalidations of an in-process
+        # cache, so its responses and users expire quickly
+        self.app.config['USE_TOKEN_AUTH'] = False
+        client = TestClient(self.app, self.default_username,
+                            self.default_password)
+        rv, json = client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 200)
+        items = get_cache().items
+        keys = [key for key in items
+                if key.split(':')[0] in ('response', 'user', 'credentials')]
+        self.assertTrue(len(keys) == 3)
+        for key in keys:
+            expires, value = items[key]
+            self.assertTrue(expires <= time.time() +
+                            self.app.config['LOCAL_CACHE_TIMEOUT'])
+
+        # a shared cache keeps them for the configured time
+        self.app.config['CACHE_TYPE'] = 'redis'
+        self.assertTrue(shared_timeout(300) == 300)
+        self.app.config['CACHE_TYPE'] = 'lru'
+        self.assertTrue(shared_timeout(300) == 5)
+        self.assertTrue(shared_timeout(0) == 5)
+
+    def test_token_keys(self):
+        u = User.query.get(1)
+        token = u.generate_auth_token()
+        self.assertTrue(User.verify_auth_token(token) == u)
+
+        # tampered and expired tokens
+        key_id, user_id, expires, signature = token.split('.')
+        self.assertTrue(User.verify_auth_token('.'.join(
+            [key_id, '2', expires, signature])) is None)
+        self.assertTrue(User.verify_auth_token(
+            u.generate_auth_token(expires_in=-1)) is None)
+
+        # rotate the signing key
+        self.app.config['TOKEN_SECRET_KEYS'] = ['new-secret', 'secret']
+        del self.app.extensions['token_signer']
+        new_token = u.generate_auth_token()
+        self.assertTrue(new_token.split('.')[0] != key_id)
+        self.assertTrue(User.verify_auth_token(token) == u)
+        self.assertTrue(User.verify_auth_token(new_token) == u)
+
+        # retire the old key
+        self.app.config['TOKEN_SECRET_KEYS'] = ['new-secret']
+        del self.app.extensions['token_signer']
+        self.assertTrue(User.verify_auth_token(token) is None)
+        self.assertTrue(User.verify_auth_token(new_token) == u)
+
+    def test_password_hashing(self):
+        self.app.config['USE_TOKEN_AUTH'] = False
+
+        # passwords hashed with an old method are upgraded on login
+        u = User.query.get(1)
+        u.password_hash = generate_password_hash(self.default_password,
+                                                 'pbkdf2:sha1:500')
+        db.session.commit()
+        client = TestClient(self.app, self.default_username,
+                            self.default_password)
+        rv, json = client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 200)
+        u = User.query.get(1)
+        self.assertTrue(u.password_hash.startswith(
+            self.app.config['PASSWORD_HASH_METHOD'] + '$'))
+
+        # verified credentials are cached
+        with self._capture_statements(
+                lambda statement: 'FROM users' in statement) as statements:
+            rv, json = client.get(self.catalog['students_url'])
+            self.assertTrue(rv.status_code == 200)
+            self.assertTrue(len(statements) == 0)
+
+        # changing the password invalidates the cached credentials
+        u.password = 'dog'
+        db.session.commit()
+        rv, json = client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 401)
+
+        # hash passwords in a thread pool
+        self.app.config['PASSWORD_HASH_POOL'] = 'thread'
+        client = TestClient(self.app, self.default_username, 'dog')
+        rv, json = client.get(self.catalog['students_url'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue('password_hash_pool' in self.app.extensions)
+        self.app.extensions['password_hash_pool'].terminate()
@@ -0,0 +1,16 @@
+import unittest
+from benchmarks import suite
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_suite(self):
+        # run every scenario a few times on a small database, to check that
+        # the requests of the suite still succeed
+        results = suite.run(students=20, classes=5,
+                            registrations_per_student=2, requests=3)
+        self.assertTrue(sorted(results) == sorted(
+            name for name, setup, f in suite.scenarios(20, 5, None)))
+        for result in results.values():
+            self.assertTrue(result['throughput'] > 0)
+            self.assertTrue(result['p50'] <= result['p99'])
+        self.assertTrue(suite.compare(results, results, 0.2) == [])
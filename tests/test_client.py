@@ -23,7 +23,7 @@ class TestClient():
             headers['Accept'] = content_type
 
         # generate a body if needed
-        if data:
+        if data and content_type == 'application/json':
             data = json.dumps(data)
 
         # send the request
@@ -38,6 +38,9 @@ class TestClient():
             except HTTPException as e:
                 rv = self.app.handle_user_exception(e)
 
+        if rv.mimetype == 'application/x-ndjson':
+            return rv, [json.loads(line) for line in
+                        rv.data.decode('utf-8').splitlines()]
         return rv, json.loads(rv.data.decode('utf-8'))
 
     def get(self, url, headers={}):